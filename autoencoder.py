@@ -1,8 +1,16 @@
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+import keras
 from keras.models import Sequential
 from keras.layers import Dense, Dropout
-from keras.callbacks import EarlyStopping
+from keras.callbacks import Callback, EarlyStopping
+from instrumentation import record_stage
 
-def build_autoencoder(input_dim, layer_ratios=[0.8, 0.5, 0.2], activation='relu', dropout=0.1, optimizer='adam', loss='mse'):
+def build_autoencoder(input_dim, layer_ratios=[0.8, 0.5, 0.2], activation='relu', dropout=0.1, optimizer='adam', loss='mse',
+                      learning_rate=None, jit_compile=False, steps_per_execution=1):
     model = Sequential()
     model.add(Dense(int(float(layer_ratios[0]) * input_dim), activation=activation, input_shape=(input_dim,)))
     model.add(Dropout(dropout))
@@ -14,12 +22,171 @@ def build_autoencoder(input_dim, layer_ratios=[0.8, 0.5, 0.2], activation='relu'
     model.add(Dense(int(float(layer_ratios[0]) * input_dim), activation=activation))
     model.add(Dropout(dropout))
     model.add(Dense(input_dim, activation='sigmoid'))
-    model.compile(optimizer=optimizer, loss=loss)
+    if learning_rate is not None:
+        optimizer = keras.optimizers.get({'class_name': optimizer, 'config': {'learning_rate': learning_rate}})
+    model.compile(optimizer=optimizer, loss=loss, jit_compile=jit_compile, steps_per_execution=steps_per_execution)
     return model
 
+def scaled_learning_rate(optimizer, batch_size, base_batch_size=None, lr_scaling='none'):
+    """
+    Learning rate for batch_size, scaled from the optimizer's default rate at base_batch_size
+
+    lr_scaling: 'linear', 'sqrt' or 'none' (returns None, i.e. keep the optimizer default)
+    """
+    if lr_scaling == 'none' or not base_batch_size:
+        return None
+    base_learning_rate = float(keras.optimizers.get(optimizer).learning_rate)
+    ratio = batch_size / base_batch_size
+    if lr_scaling == 'linear':
+        return base_learning_rate * ratio
+    if lr_scaling == 'sqrt':
+        return base_learning_rate * np.sqrt(ratio)
+    raise ValueError("Unsupported lr_scaling. Use 'linear', 'sqrt' or 'none'.")
+
+def build_autoencoder_from_config(input_dim, config, **overrides):
+    """
+    Build an autoencoder from the 'autoencoder' section of the hyperparameters
+
+    Applies the learning rate scaling, jit_compile and steps_per_execution options;
+    overrides replace individual config entries (e.g. in a hyperparameter search).
+    """
+    config = dict(config, **overrides)
+    learning_rate = scaled_learning_rate(config['optimizer'], config['batch_size'],
+                                         config.get('base_batch_size'), config.get('lr_scaling', 'none'))
+    return build_autoencoder(input_dim, config['ratios'], config['hidden_activation'], config['dropout'],
+                             config['optimizer'], config['loss'], learning_rate, config.get('jit_compile', False),
+                             config.get('steps_per_execution', 1))
+
+def build_feature_model(autoencoder, reconstruction_models, keep, n_features):
+    """
+    One model computing the logistic model inputs from all scaled features in a single forward pass
+
+    Outputs the bottleneck encoding of the kept columns under autoencoder, followed by
+    log1p of the per-row reconstruction MSE of every model in reconstruction_models
+    (the fraud and non-fraud autoencoders of the feature selection, trained on all
+    features). The layers are shared with the given models, not copied.
+    """
+    inputs = keras.Input((n_features,))
+    encoding = Sequential(autoencoder.layers[:4], name='encoder')(keras.ops.take(inputs, np.asarray(keep), axis=1))
+    # Wrapped in uniquely named models, as the saved autoencoders may share a name
+    reconstructions = [Sequential(model.layers, name=f'reconstruction_{i}')(inputs)
+                       for i, model in enumerate(reconstruction_models)]
+    errors = [keras.ops.log1p(keras.ops.mean(keras.ops.square(reconstruction - inputs), axis=1, keepdims=True))
+              for reconstruction in reconstructions]
+    return keras.Model(inputs, keras.ops.concatenate([encoding] + errors, axis=1))
+
+def load_autoencoder_from_config(path, config):
+    """
+    Load a saved autoencoder and compile it with the optimizer settings of config, to continue training it
+    """
+    model = keras.models.load_model(path, compile=False)
+    optimizer = config['optimizer']
+    learning_rate = scaled_learning_rate(config['optimizer'], config['batch_size'],
+                                         config.get('base_batch_size'), config.get('lr_scaling', 'none'))
+    if learning_rate is not None:
+        optimizer = keras.optimizers.get({'class_name': optimizer, 'config': {'learning_rate': learning_rate}})
+    model.compile(optimizer=optimizer, loss=config['loss'], jit_compile=config.get('jit_compile', False),
+                  steps_per_execution=config.get('steps_per_execution', 1))
+    return model
+
+def make_dataset(data, batch_size, shuffle=False, seed=None, repeat=1):
+    """
+    tf.data pipeline feeding (x, x) float32 batches to an autoencoder
+
+    The data is converted to a float32 tensor once. Shuffling permutes row indices
+    every epoch and each batch is one vectorized gather, so no per-row Python or
+    tf.data element work is done; batches are prefetched while the model trains.
+    With repeat > 1 every row appears repeat times per epoch, shuffled together.
+    """
+    tensor = tf.constant(np.ascontiguousarray(data, dtype=np.float32))
+    indices = tf.data.Dataset.range(len(data) * repeat)
+    if shuffle:
+        indices = indices.shuffle(len(data) * repeat, seed=seed, reshuffle_each_iteration=True)
+
+    def gather(batch):
+        x = tf.gather(tensor, batch % len(data))
+        return x, x
+
+    return indices.batch(batch_size).map(gather, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+class ThroughputCallback(Callback):
+    """
+    Record rows/sec and step time for every training epoch, also as an autoencoder_epoch stage
+
+    The rates are added to the epoch logs (and so the history) and only printed when
+    fit() was called with a non-zero verbose.
+    """
+
+    def __init__(self, n_rows, batch_size):
+        super().__init__()
+        self.n_rows = n_rows
+        self.steps = int(np.ceil(n_rows / batch_size))
+        self.rows_per_sec = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start, self.start_cpu = time.perf_counter(), time.process_time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self.start
+        record_stage('autoencoder_epoch', seconds, time.process_time() - self.start_cpu, self.n_rows)
+        self.rows_per_sec.append(self.n_rows / seconds)
+        if logs is not None:
+            logs['rows_per_sec'] = self.rows_per_sec[-1]
+        if self.params.get('verbose', 1):
+            print(f"Epoch {epoch + 1}: {self.rows_per_sec[-1]:.0f} rows/s, {1000 * seconds / self.steps:.2f} ms/step")
+
+class EpochCheckpoint(Callback):
+    """
+    Save the model (with its optimizer state) and the finished epoch count after every epoch
+
+    Both files in directory are replaced atomically, so an interrupted run can be
+    resumed from the last complete epoch with load_checkpoint.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def on_epoch_end(self, epoch, logs=None):
+        os.makedirs(self.directory, exist_ok=True)
+        model_path = os.path.join(self.directory, 'autoencoder.keras')
+        self.model.save(model_path + '.tmp.keras')
+        os.replace(model_path + '.tmp.keras', model_path)
+        with open(os.path.join(self.directory, 'state.json.tmp'), 'w') as f:
+            json.dump({'epoch': epoch + 1}, f)
+        os.replace(os.path.join(self.directory, 'state.json.tmp'), os.path.join(self.directory, 'state.json'))
+
+def load_checkpoint(directory):
+    """(model, finished epochs) saved by EpochCheckpoint, or (None, 0) when there is none"""
+    state_path = os.path.join(directory, 'state.json')
+    if not os.path.exists(state_path):
+        return None, 0
+    with open(state_path, 'r') as f:
+        epoch = json.load(f)['epoch']
+    return keras.models.load_model(os.path.join(directory, 'autoencoder.keras')), epoch
+
+def fit_autoencoder(autoencoder, train_data, val_data, epochs=10, batch_size=32, callbacks=None, verbose='auto', seed=None,
+                    initial_epoch=0, repeat=1):
+    """
+    Train an autoencoder to reconstruct train_data through the tf.data input pipeline
+
+    Validation runs on val_data in large batches; per-epoch throughput is printed and
+    stored in history.history['rows_per_sec']. initial_epoch resumes a run that
+    already finished that many of its epochs. repeat > 1 passes over the rows
+    several times per epoch, for very small sets such as the frauds.
+    """
+    throughput = ThroughputCallback(len(train_data) * repeat, batch_size)
+    return autoencoder.fit(
+        make_dataset(train_data, batch_size, shuffle=True, seed=seed, repeat=repeat),
+        epochs=epochs,
+        initial_epoch=initial_epoch,
+        validation_data=make_dataset(val_data, max(batch_size, 8192)),
+        callbacks=[throughput] + list(callbacks or []),
+        verbose=verbose
+    )
+
 def train_autoencoder(train_data, val_data, autoencoder, epochs=50, batch_size=256):
     early_stopping = EarlyStopping(monitor='val_loss', patience=5)
-    autoencoder.fit(train_data, train_data, epochs=epochs, batch_size=batch_size, 
-              validation_data=(val_data, val_data), callbacks=[early_stopping])
+    fit_autoencoder(autoencoder, train_data, val_data, epochs, batch_size, callbacks=[early_stopping])
     encoder = Sequential(autoencoder.layers[:4])  # Extract encoder part
-    return autoencoder, encoder
\ No newline at end of file
+    return autoencoder, encoder
@@ -0,0 +1,148 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from prepare_data import file_md5, read_cached_csv
+from scoring import ScoringService
+
+# Bump whenever the shard layout changes
+BATCH_SCORES_VERSION = 1
+
+# Thread pools a worker is limited to. One thread per worker keeps every row on the same
+# code path whatever the worker count, so the output is bit-for-bit reproducible.
+THREAD_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS',
+              'TF_NUM_INTEROP_THREADS')
+
+_service = None
+
+def _load_worker(models_dir, backend):
+    """Load the saved models once per worker process"""
+    global _service
+    if backend == 'keras':
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(1)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    _service = ScoringService(models_dir, backend=backend)
+
+def _sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def score_shard(array_path, columns, target_column, start, end, chunk_size, output_path):
+    """
+    Score rows start:end of a memory-mapped input array and write them to output_path
+
+    The output is a structured .npy array with the fraud 'score' (float32), the
+    'label' at the saved threshold and, when the input has one, the 'target'.
+    """
+    values = np.load(array_path, mmap_mode='r')
+    features = np.array([columns.index(name) for name in _service.feature_names], dtype=np.intp)
+    fields = [('score', '<f4'), ('label', 'i1')]
+    if target_column in columns:
+        fields.append(('target', 'i1'))
+    predictions = np.empty(end - start, dtype=fields)
+    for chunk_start in range(start, end, chunk_size):
+        chunk = np.asarray(values[chunk_start:min(chunk_start + chunk_size, end)])
+        scores = _service.score_batch(np.ascontiguousarray(chunk[:, features], dtype=np.float32))
+        rows = slice(chunk_start - start, chunk_start - start + len(chunk))
+        predictions['score'][rows] = scores
+        predictions['label'][rows] = scores > _service.threshold
+        if target_column in columns:
+            predictions['target'][rows] = chunk[:, columns.index(target_column)]
+    tmp_path = output_path + '.tmp.npy'
+    np.save(tmp_path, predictions)
+    os.replace(tmp_path, output_path)
+    return {'file': os.path.basename(output_path), 'start_row': start, 'end_row': end,
+            'sha256': _sha256(output_path)}
+
+def score_file(input_path, output_dir, models_dir='saved best models', workers=None, shard_rows=1000000,
+               chunk_size=65536, backend='fused', target_column='Class', cache_dir='cached data'):
+    """
+    Score a large input file in row-range shards across a process pool
+
+    The file is read through the memory-mapped binary cache in cache_dir (built on
+    the first run), so every worker reads only its own rows. Each worker loads the
+    saved models once; shards of shard_rows rows are scored in chunks of chunk_size
+    and written to output_dir/scores_<shard>.npy, and manifest.json lists the shards
+    with their row ranges and sha256, the input and model hashes and the throughput.
+    Shard and chunk boundaries depend only on shard_rows and chunk_size, not on
+    workers, so the output files are identical for any number of workers.
+    """
+    start_time = time.perf_counter()
+    md5 = file_md5(input_path, cache_dir)
+    array_path = os.path.join(cache_dir, f'{md5}.npy')
+    meta_path = os.path.join(cache_dir, f'{md5}.json')
+    if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+        # Only builds the cache; the rows themselves are read by the workers
+        _, source = read_cached_csv(input_path, md5, cache_dir)
+        if source == 'csv':
+            raise ValueError(f"{input_path} has non-numeric columns and cannot be scored from the binary cache.")
+    n_rows = np.load(array_path, mmap_mode='r').shape[0]
+    with open(meta_path, 'r') as f:
+        columns = json.load(f)['columns']
+    shards = [(start, min(start + shard_rows, n_rows)) for start in range(0, n_rows, shard_rows)]
+    workers = max(1, min(workers or os.cpu_count(), len(shards)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    for stale in glob.glob(os.path.join(output_dir, 'scores_*.npy')):
+        os.remove(stale)
+    # Spawned workers inherit the environment, so their thread pools are pinned before NumPy starts
+    saved_env = {name: os.environ.get(name) for name in THREAD_ENV}
+    os.environ.update({name: '1' for name in THREAD_ENV})
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_load_worker, initargs=(models_dir, backend)) as executor:
+            futures = [executor.submit(score_shard, array_path, columns, target_column,
+                                       start, end, chunk_size, os.path.join(output_dir, f'scores_{i:05d}.npy'))
+                       for i, (start, end) in enumerate(shards)]
+            shard_entries = [future.result() for future in futures]
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    seconds = time.perf_counter() - start_time
+    model_file = 'fused_model.npz' if backend == 'fused' else 'encoder_model.h5'
+    if backend == 'keras' and os.path.exists(os.path.join(models_dir, 'feature_model.keras')):
+        model_file = 'feature_model.keras'
+    manifest = {
+        'version': BATCH_SCORES_VERSION,
+        'input': input_path,
+        'input_md5': md5,
+        'models': {name: file_md5(os.path.join(models_dir, name), cache_dir)
+                   for name in ([model_file] if backend == 'fused' else
+                                [model_file, 'scaler.pkl', 'logistic_model.pkl', 'features_dropped.json'])},
+        'backend': backend,
+        'rows': n_rows,
+        'shard_rows': shard_rows,
+        'chunk_size': chunk_size,
+        'workers': workers,
+        'seconds': seconds,
+        'rows_per_sec': n_rows / seconds if seconds else None,
+        # Hash of the shard hashes in order, to compare runs at a glance
+        'sha256': hashlib.sha256(''.join(entry['sha256'] for entry in shard_entries).encode()).hexdigest(),
+        'shards': shard_entries
+    }
+    with open(os.path.join(output_dir, 'manifest.json.tmp'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(os.path.join(output_dir, 'manifest.json.tmp'), os.path.join(output_dir, 'manifest.json'))
+    print(f"Scored {n_rows} rows of {input_path} in {len(shards)} shards with {workers} workers "
+          f"in {seconds:.2f}s ({manifest['rows_per_sec']:.0f} rows/s)")
+    return manifest
+
+def load_scores(output_dir, mmap=True):
+    """Predictions written by score_file, in input row order, as one structured array"""
+    with open(os.path.join(output_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    shards = [np.load(os.path.join(output_dir, entry['file']), mmap_mode='r' if mmap else None)
+              for entry in manifest['shards']]
+    return np.concatenate(shards) if len(shards) != 1 else shards[0]
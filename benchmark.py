@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+FEATURES = [f'V{i}' for i in range(1, 29)] + ['Amount']
+STAGES = ['load', 'importance_re', 'importance_fpi', 'autoencoder_epoch', 'encode', 'train_model',
+          'train_model_out_of_core', 'fs', 'pipeline']
+# Row shares of dev/oos/oot, as in the creditcard input data
+SPLITS = {'dev': 0.56, 'oos': 0.21, 'oot': 0.23}
+
+def generate_synthetic_data(n_rows, fraud_rate=0.0017, seed=42):
+    """
+    Synthetic transactions with the schema of the input data: V1-V28, Amount and Class
+
+    V1-V28 are standard normal, Amount is log-normal and about fraud_rate of the rows
+    are frauds whose V1-V14 and Amount are shifted, so the autoencoders and the
+    logistic model have a signal to pick up.
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((n_rows, 28), dtype=np.float32)
+    fraud = rng.random(n_rows) < fraud_rate
+    data[fraud, :14] += rng.normal(1.5, 0.5, size=14).astype(np.float32)
+    amount = np.round(rng.lognormal(3.0, 1.5, n_rows) * np.where(fraud, 1.5, 1.0), 2)
+    frame = pd.DataFrame(data, columns=FEATURES[:28])
+    frame['Amount'] = amount
+    frame['Class'] = fraud.astype(int)
+    return frame
+
+def write_synthetic_inputs(directory, n_rows, fraud_rate=0.0017, seed=42, chunk_rows=1000000):
+    """
+    Write dev/oos/oot CSVs with n_rows in total to directory, chunk by chunk
+
+    Existing files are reused, so every benchmark at the same size and seed reads the
+    same inputs. Returns the three paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for i, (split, share) in enumerate(SPLITS.items()):
+        path = paths[split] = os.path.join(directory, f'{split}.csv')
+        if os.path.exists(path):
+            continue
+        rows = int(n_rows * share)
+        with open(path + '.tmp', 'w') as f:
+            for chunk, start in enumerate(range(0, rows, chunk_rows)):
+                frame = generate_synthetic_data(min(chunk_rows, rows - start), fraud_rate, [seed, i, chunk])
+                frame.to_csv(f, index=False, header=chunk == 0)
+        os.replace(path + '.tmp', path)
+    return paths['dev'], paths['oos'], paths['oot']
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def _run_stage(stage, paths, hyperparameters, workdir, total_rows):
+    """Run one benchmark stage in the current (fresh) process and measure it"""
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    from prepare_data import preprocess_data, encode_data, peak_rss_mb
+    from feature_selection import get_feature_importance
+    from autoencoder import build_autoencoder_from_config, fit_autoencoder
+    from model import train_model, train_model_out_of_core
+    from keras.models import Sequential
+
+    hp = dict(hyperparameters, train_file=paths[0], validation_file=paths[1], test_file=paths[2],
+              data_cache=os.path.join(workdir, 'cached data'), fs_cache=False)
+    target = hp['target_column']
+    ae_config = hp['autoencoder']
+
+    # Untimed setup: the preprocessed data and, where needed, a model to run
+    if stage in ('load', 'fs', 'pipeline'):
+        shutil.rmtree(hp['data_cache'], ignore_errors=True)
+    else:
+        data = preprocess_data(*paths, target, hp['data_cache'])
+        normal = np.asarray(data['dev_scaled'][data['dev_NF_idx']])
+        autoencoder = build_autoencoder_from_config(normal.shape[1], ae_config)
+        encoder = Sequential(autoencoder.layers[:4])
+        if stage in ('train_model', 'train_model_out_of_core'):
+            encoded = [encode_data(encoder, data[f'{split}_scaled'], hp['encode_chunk_size']) for split in SPLITS]
+    setup_rss = peak_rss_mb()
+
+    start_wall, start_cpu = time.perf_counter(), _cpu_seconds()
+    if stage == 'load':
+        data = preprocess_data(*paths, target, None)
+        rows = sum(len(data[f'{split}_scaled']) for split in SPLITS)
+    elif stage in ('importance_re', 'importance_fpi'):
+        get_feature_importance(autoencoder, normal, stage.split('_')[1], hp['fpi'])
+        rows = len(normal) if stage == 'importance_re' else min(len(normal), hp['fpi'].get('sample_size') or len(normal))
+    elif stage == 'autoencoder_epoch':
+        fit_autoencoder(autoencoder, normal, normal[:8192], 1, ae_config['batch_size'], verbose=0)
+        rows = len(normal)
+    elif stage == 'encode':
+        encode_data(encoder, data['dev_scaled'], hp['encode_chunk_size'])
+        rows = len(data['dev_scaled'])
+    elif stage == 'train_model':
+        train_model(np.concatenate(encoded[:2]), np.concatenate([data['y_dev'], data['y_oos']]), encoded[2],
+                    data['y_oot'], hp['model'], hp['model_params'], hp['model_threshold'])
+        rows = len(encoded[0]) + len(encoded[1])
+    elif stage == 'train_model_out_of_core':
+        # Training only, without the lbfgs parity fit
+        train_model_out_of_core([(encoded[0], data['y_dev']), (encoded[1], data['y_oos'])], encoded[2], data['y_oot'],
+                                hp['model_params'], hp['model_threshold'], dict(hp['out_of_core'], parity_rows=0))
+        rows = len(encoded[0]) + len(encoded[1])
+    elif stage in ('fs', 'pipeline'):
+        from pipeline import fs, pipeline
+        (fs if stage == 'fs' else pipeline)(hp)
+        rows = total_rows
+    else:
+        raise ValueError(f"Unknown benchmark stage {stage}. Use one of {STAGES}.")
+    wall = time.perf_counter() - start_wall
+
+    return {
+        'stage': stage,
+        'rows': rows,
+        'wall_seconds': wall,
+        'cpu_seconds': _cpu_seconds() - start_cpu,
+        'rows_per_sec': rows / wall if wall else None,
+        'setup_peak_rss_mb': setup_rss,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def run_benchmarks(row_counts, stages=STAGES, hyperparameters=None, data_dir='benchmark data',
+                   work_dir='benchmark work', epochs=1, seed=42):
+    """
+    Time every stage at every row count, each in a fresh process
+
+    A fresh spawn process per measurement keeps peak RSS per stage and stops
+    TensorFlow state from leaking between runs. Autoencoders train for epochs epochs
+    in the 'fs' and 'pipeline' runs. Returns the result dicts in run order.
+    """
+    if hyperparameters is None:
+        with open('default_hyperparameters.json', 'r') as f:
+            hyperparameters = json.load(f)
+    hyperparameters = dict(hyperparameters, autoencoder=dict(hyperparameters['autoencoder'], epochs=epochs))
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for n_rows in row_counts:
+        paths = [os.path.abspath(path) for path in
+                 write_synthetic_inputs(os.path.join(data_dir, f'{n_rows}_rows_seed_{seed}'), n_rows, seed=seed)]
+        for stage in stages:
+            # ProcessPoolExecutor workers are not daemonic, so fs can start its own workers
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_stage, stage, paths, hyperparameters,
+                                         os.path.abspath(os.path.join(work_dir, f'{stage}_{n_rows}')),
+                                         sum(int(n_rows * share) for share in SPLITS.values())).result()
+            result['total_rows'] = n_rows
+            print(f"{stage} @ {n_rows} rows: {result['wall_seconds']:.2f}s wall, {result['cpu_seconds']:.2f}s cpu, "
+                  f"{result['peak_rss_mb']:.0f} MB peak RSS")
+            results.append(result)
+    return results
+
+def save_benchmark_results(results, output_dir='benchmark results'):
+    """Write results with the machine and library versions to a timestamped JSON file"""
+    import sklearn
+    import tensorflow as tf
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, 'w') as f:
+        json.dump({
+            'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                        'cpu_count': os.cpu_count(), 'python': platform.python_version()},
+            'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__,
+                         'tensorflow': tf.__version__},
+            'results': results
+        }, f, indent=4)
+    return path
@@ -0,0 +1,56 @@
+import os
+import sys
+import json
+import argparse
+import importlib
+import traceback
+
+# command: (module, function, whether it takes options, help). A command's module is only imported when it runs,
+# so TensorFlow, MLflow, sklearn and matplotlib are never loaded by commands that do not use them.
+COMMANDS = {
+    'fs': ('run_fs', 'run_feature_selection', False, "feature selection (run_fs.py)"),
+    'fp': ('run_fp', 'run_pipeline', False, "final pipeline or warm-start retrain (run_fp.py)"),
+    'search': ('run_search', 'run_search', False, "hyperparameter search (run_search.py)"),
+    'encode': ('run_encode', 'main', True, "encode a file with the saved models (run_encode.py)"),
+    'score': ('run_score', 'main', True, "serve the saved models (run_score.py)"),
+    'batch-score': ('run_batch_score', 'main', True, "score a large file in parallel shards (run_batch_score.py)"),
+    'profile': ('run_profile', 'run_profile', False, "profile the inputs and report drift (run_profile.py)"),
+    'bench': ('run_bench', 'main', True, "benchmark the stages on synthetic data (run_bench.py)"),
+    'check-imports': ('import_times', 'main', True, "check the start-up import time of the commands"),
+}
+
+def show_features(argv):
+    """Print the saved list of dropped features without importing anything heavy"""
+    parser = argparse.ArgumentParser(prog='cli.py features', description="Print the dropped features")
+    parser.add_argument("--models-dir", default="saved best models")
+    args = parser.parse_args(argv)
+    with open(os.path.join(args.models_dir, 'features_dropped.json'), 'r') as f:
+        features_to_drop = json.load(f)
+    print(f"{len(features_to_drop)} features dropped: {features_to_drop}")
+    return 0
+
+def main(argv=None):
+    commands = dict(COMMANDS, features=(None, None, True, "print the features dropped by the saved models"))
+    parser = argparse.ArgumentParser(
+        prog='cli.py', description="Fraud pipeline commands; 'python cli.py <command> --help' for their options",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n" + "\n".join(f"  {name:<16}{command[3]}" for name, command in commands.items()))
+    parser.add_argument("command", choices=commands, metavar="command")
+    parser.add_argument("options", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    if args.command == 'features':
+        return show_features(args.options)
+    module, function, takes_options, _ = COMMANDS[args.command]
+    if args.options and not takes_options:
+        parser.error(f"{args.command} takes no options, it reads default_hyperparameters.json")
+    run = getattr(importlib.import_module(module), function)
+    try:
+        result = run(args.options) if takes_options else run()
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return result if isinstance(result, int) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
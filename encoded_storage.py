@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import zipfile
+import tempfile
+import numpy as np
+import pandas as pd
+
+def save_encoded(path, encoded, target, index=None, compress=False):
+    """
+    Write encoded features with their row index and target as one .npz file
+
+    features are stored as float32, target as int8 and index as int64 (the row
+    position in the source file by default); target is left out when None (unlabelled
+    input). Uncompressed files can be memory-mapped by load_encoded; compress=True
+    trades that for a smaller file. Memory-mapped inputs are copied into the archive
+    in blocks, without loading them.
+    """
+    encoded = np.asarray(encoded)
+    arrays = {
+        'features': np.ascontiguousarray(encoded, dtype=np.float32),
+        'index': np.arange(len(encoded), dtype=np.int64) if index is None else np.asarray(index, dtype=np.int64)
+    }
+    if target is not None:
+        arrays['target'] = np.asarray(target, dtype=np.int8)
+    if any(len(array) != len(encoded) for array in arrays.values()):
+        raise ValueError("encoded, target and index must have the same number of rows.")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        (np.savez_compressed if compress else np.savez)(f, **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+class EncodedWriter:
+    """
+    Append encoded chunks and write them through save_encoded as one .npz file
+
+    Chunks go to raw float32/int8 spill files next to path, so only one chunk is held
+    in memory; close() memory-maps the spill files into save_encoded and removes them.
+    """
+
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.compress = compress
+        self.rows = 0
+        self.columns = None
+        self.labelled = None
+        self._files = {}
+
+    def append(self, encoded, target=None):
+        encoded = np.ascontiguousarray(encoded, dtype=np.float32)
+        if self.columns is None:
+            self.columns, self.labelled = encoded.shape[1], target is not None
+            self._files['features'] = open(self.path + '.features.tmp', 'wb')
+            if self.labelled:
+                self._files['target'] = open(self.path + '.target.tmp', 'wb')
+        encoded.tofile(self._files['features'])
+        if self.labelled:
+            np.asarray(target, dtype=np.int8).tofile(self._files['target'])
+        self.rows += len(encoded)
+
+    def close(self):
+        """Write the .npz file, returns its path (None when nothing was appended)"""
+        if self.columns is None:
+            return None
+        for f in self._files.values():
+            f.close()
+        try:
+            # np.memmap cannot map an empty file
+            features = np.memmap(self._files['features'].name, dtype=np.float32, mode='r',
+                                 shape=(self.rows, self.columns)) if self.rows else np.empty((0, self.columns))
+            target = None
+            if self.labelled:
+                target = np.memmap(self._files['target'].name, dtype=np.int8, mode='r',
+                                   shape=(self.rows,)) if self.rows else np.empty(0)
+            save_encoded(self.path, features, target, compress=self.compress)
+            del features, target
+        finally:
+            for f in self._files.values():
+                os.remove(f.name)
+        return self.path
+
+def _memmap_member(path, archive, name):
+    """Memory-map an uncompressed .npy member of a .npz archive in place"""
+    info = archive.getinfo(name)
+    with open(path, 'rb') as f:
+        # Local file header: 30 fixed bytes, then the file name and extra field
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = (int(n) for n in np.frombuffer(f.read(4), dtype='<u2'))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+def load_encoded(path, mmap=True):
+    """
+    Read a file written by save_encoded as {'features', 'target', 'index'}
+
+    With mmap=True the arrays of an uncompressed file are memory-mapped, so only
+    the rows a model touches are read from disk; compressed files are loaded.
+    """
+    with zipfile.ZipFile(path) as archive:
+        stored = all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+        if mmap and stored:
+            return {name[:-4]: _memmap_member(path, archive, name) for name in archive.namelist()}
+    with np.load(path) as saved:
+        return {name: saved[name] for name in saved.files}
+
+def compare_with_csv(encoded, target, directory=None, repeats=3):
+    """
+    Write/read time and file size of the .npz formats against the encoded CSV dumps
+
+    Reads are timed up to a dense float32 feature matrix, the form the models consume.
+    """
+    directory = directory or tempfile.mkdtemp()
+    paths = {'csv': os.path.join(directory, 'encoded.csv'),
+             'npz': os.path.join(directory, 'encoded.npz'),
+             'npz_compressed': os.path.join(directory, 'encoded_compressed.npz')}
+    writers = {'csv': lambda: pd.DataFrame(encoded, copy=False).to_csv(paths['csv'], index=False),
+               'npz': lambda: save_encoded(paths['npz'], encoded, target),
+               'npz_compressed': lambda: save_encoded(paths['npz_compressed'], encoded, target, compress=True)}
+    readers = {'csv': lambda: pd.read_csv(paths['csv']).to_numpy(dtype=np.float32),
+               'npz': lambda: np.array(load_encoded(paths['npz'])['features']),
+               'npz_compressed': lambda: load_encoded(paths['npz_compressed'])['features']}
+
+    results = {'rows': len(encoded), 'columns': encoded.shape[1]}
+    for name in paths:
+        for step, function in [('write', writers[name]), ('read', readers[name])]:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                function()
+            results[f'{name}_{step}_seconds'] = (time.perf_counter() - start) / repeats
+        results[f'{name}_mb'] = os.path.getsize(paths[name]) / 1024 ** 2
+    return results
+
+if __name__ == "__main__":
+    # python encoded_storage.py "encoded data/encoded_dev.npz": CSV vs .npz on the saved encoding
+    # (random data of the same shape as the creditcard set when no file is given)
+    if len(sys.argv) > 1:
+        saved = load_encoded(sys.argv[1], mmap=False)
+        encoded, target = saved['features'], saved['target']
+    else:
+        rng = np.random.default_rng(42)
+        encoded, target = rng.standard_normal((285000, 6), dtype=np.float32), rng.random(285000) < 0.0017
+    print(compare_with_csv(encoded, target))
@@ -1,10 +1,24 @@
+import os
+import ast
+import json
+import time
+import hashlib
+import shutil
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from keras.callbacks import History
+from keras.models import load_model
 from prepare_data import *
 from autoencoder import *
+from instrumentation import instrument, stage_records, add_stage_records
+from sampling import ranking_convergence
 
-def get_feature_importance(model, data, method='reconstruction_error'):
+def get_feature_importance(model, data, method='reconstruction_error', fpi_params=None):
     """
     Calculate feature importance using either reconstruction error or FPI method
     
@@ -12,25 +26,112 @@ def get_feature_importance(model, data, method='reconstruction_error'):
         model: trained autoencoder model
         data: input data
         method: 'reconstruction_error' or 'fpi'
+        fpi_params: keyword arguments passed to permutation_importance
     """
     if method == 're':
         predictions = model.predict(data)
         importance = np.mean((predictions - data) ** 2, axis=0)
     
     elif method == 'fpi':
-        baseline_error = np.mean((model.predict(data) - data) ** 2)
-        importance = []
-        
-        for i in range(data.shape[1]):
-            permuted_data = data.copy()
-            permuted_data[:, i] = np.random.permutation(permuted_data[:, i])
-            permuted_error = np.mean((model.predict(permuted_data) - data) ** 2)
-            importance.append(permuted_error - baseline_error)
-        
-        importance = np.array(importance)
+        importance = permutation_importance(model, data, **(fpi_params or {}))
     
     return importance
 
+def get_feature_importances(model, data, methods=('re', 'fpi'), fpi_params=None, convergence=None):
+    """
+    Feature importance for several methods from one set of forward passes
+    
+    The reconstruction of data is computed once and serves both as the 're' importance
+    and as the FPI baseline, so 'fpi' only adds the permuted passes.
+    convergence: optional {'fractions', 'top_k', 'seed'}; the importance is then also
+        computed on random subsets of those fractions of the rows and compared with
+        the full one (see sampling.ranking_convergence), stored as '<method>_convergence'.
+        For 're' this reuses the per-row errors; for 'fpi' it repeats the permuted
+        passes on subsets of the rows the FPI run sampled (fpi_sample_rows).
+    """
+    fpi_params = dict(fpi_params or {})
+    data = np.asarray(data, dtype=np.float32)
+    importances, predictions = {}, None
+    if 're' in methods:
+        predictions = model.predict(data, batch_size=fpi_params.get('batch_size', 8192), verbose=0)
+        errors = (predictions - data) ** 2
+        importances['re'] = errors.mean(axis=0)
+        if convergence:
+            importances['re_convergence'] = ranking_convergence(
+                lambda rows: errors[rows].mean(axis=0), len(data), importances['re'],
+                convergence.get('fractions', (0.25, 0.5)), convergence.get('top_k', 5), convergence.get('seed', 42))
+        del errors
+    if 'fpi' in methods:
+        importances['fpi'] = permutation_importance(model, data, predictions=predictions, **fpi_params)
+        if convergence:
+            # The same rows permutation_importance scored, subsets of them without subsampling again
+            fpi_rows = fpi_sample_rows(np.random.default_rng(fpi_params.get('random_state', 42)), len(data),
+                                       fpi_params.get('sample_size'))
+            sample = data if fpi_rows is None else data[fpi_rows]
+            subset_params = dict(fpi_params, sample_size=None)
+            importances['fpi_convergence'] = ranking_convergence(
+                lambda rows: permutation_importance(model, sample[rows], **subset_params), len(sample),
+                importances['fpi'],
+                convergence.get('fractions', (0.25, 0.5)), convergence.get('top_k', 5), convergence.get('seed', 42))
+    return importances
+
+def fpi_sample_rows(rng, n_rows, sample_size):
+    """The sorted rows permutation_importance scores on, None for all of them; draws from rng first"""
+    if sample_size and sample_size < n_rows:
+        return np.sort(rng.choice(n_rows, sample_size, replace=False))
+    return None
+
+def permutation_importance(model, data, n_repeats=1, sample_size=None, batch_size=8192,
+                           max_buffer_rows=262144, random_state=42, predictions=None):
+    """
+    Batched feature permutation importance for an autoencoder
+    
+    Every (repeat, feature) pair becomes one block of a preallocated float32 buffer
+    holding a copy of the (optionally subsampled) data with that single column
+    permuted. Blocks are scored with one large predict per buffer fill and the
+    per-feature error deltas are reduced in a single vectorized step.
+    
+    Args:
+        model: trained autoencoder model
+        data: input data
+        n_repeats: number of permutations per feature, averaged
+        sample_size: number of rows to score on, None for all rows
+        batch_size: batch size used for model.predict
+        max_buffer_rows: upper bound on rows held in the permutation buffer
+        random_state: seed for row subsampling and permutations
+        predictions: model.predict(data) if already computed, reused for the baseline
+    """
+    rng = np.random.default_rng(random_state)
+    data = np.asarray(data, dtype=np.float32)
+    rows = fpi_sample_rows(rng, data.shape[0], sample_size)
+    if rows is not None:
+        data = data[rows]
+        predictions = None if predictions is None else predictions[rows]
+    n_rows, n_features = data.shape
+
+    if predictions is None:
+        predictions = model.predict(data, batch_size=batch_size, verbose=0)
+    baseline_error = np.mean((predictions - data) ** 2)
+
+    # One block per (repeat, feature) pair, filled and scored buffer by buffer
+    tasks = [(r, i) for r in range(n_repeats) for i in range(n_features)]
+    blocks_per_fill = max(1, min(len(tasks), max_buffer_rows // n_rows))
+    buffer = np.empty((blocks_per_fill, n_rows, n_features), dtype=np.float32)
+    permuted_errors = np.empty((n_repeats, n_features))
+
+    for start in range(0, len(tasks), blocks_per_fill):
+        chunk = tasks[start:start + blocks_per_fill]
+        blocks = buffer[:len(chunk)]
+        blocks[:] = data
+        for b, (_, i) in enumerate(chunk):
+            blocks[b, :, i] = data[rng.permutation(n_rows), i]
+        predictions = model.predict(blocks.reshape(-1, n_features), batch_size=batch_size, verbose=0)
+        errors = np.mean((predictions.reshape(blocks.shape) - data) ** 2, axis=(1, 2))
+        for b, (r, i) in enumerate(chunk):
+            permuted_errors[r, i] = errors[b]
+
+    return permuted_errors.mean(axis=0) - baseline_error
+
 def save_feature_importance(importance_scores, feature_names, method, prefix):
     """
     Save feature importance scores to CSV
@@ -42,6 +143,19 @@ def save_feature_importance(importance_scores, feature_names, method, prefix):
     df = df.sort_values('Importance', ascending=False)
     df.to_csv(f'feature selection/{prefix}_{method}_importance.csv', index=False)
 
+def save_importance_convergence(convergence, method, prefix, min_spearman=0.9):
+    """
+    Save and print the ranking convergence from get_feature_importances, warning when it has not stabilized
+    """
+    df = pd.DataFrame(convergence, columns=['Rows', 'Spearman', 'TopKOverlap']).astype({'Rows': int})
+    df.to_csv(f'feature selection/{prefix}_{method}_convergence.csv', index=False)
+    print(f"{prefix.capitalize()} {method} importance ranking against the full sample:")
+    print(df.to_string(index=False))
+    # The largest subset before the full sample
+    if len(df) > 1 and df['Spearman'].iloc[-2] < min_spearman:
+        print(f"Warning: the {prefix} {method} ranking has not converged (Spearman {df['Spearman'].iloc[-2]:.3f} "
+              f"< {min_spearman} at {df['Rows'].iloc[-2]} rows), consider a larger sample.")
+
 def plot_feature_importance(importance_scores, feature_names, method, prefix):
     """
     Create horizontal bar plot of feature importance scores
@@ -58,44 +172,279 @@ def plot_feature_importance(importance_scores, feature_names, method, prefix):
     plt.savefig(f'figures/{prefix}_{method}_importance.png')
     plt.close()
 
-def feature_selection(dev_F, dev_NF, oos_F, oos_NF, feature_names, method, feature_threshold, 
-                     ratios=[0.8,0.5,0.2], hidden_activation='relu', dropout=0.1, 
-                     optimizer='adam', loss='mse', epochs=10, batch_size=32):
+def train_and_score(train_data, val_data, method, ratios=[0.8,0.5,0.2], hidden_activation='relu',
+                    dropout=0.1, optimizer='adam', loss='mse', epochs=10, batch_size=32, fpi_params=None,
+                    training=None, importance_data=None, repeat=1, convergence=None):
+    """
+    Train one autoencoder and score its feature importance, timing both steps
     
-    # Build and train fraud autoencoder
-    autoencoder_F = build_autoencoder(dev_F.shape[1], ratios, hidden_activation, dropout, optimizer, loss)
-    history_F = autoencoder_F.fit(
-        dev_F, dev_F,
-        epochs=epochs,
-        batch_size=batch_size,
-        validation_data=(oos_F, oos_F)
-    )
+    method: one importance method or a list of them; importances are returned as a
+        {method: vector} dict
+    training: optional {'base_batch_size', 'lr_scaling', 'jit_compile', 'steps_per_execution'}
+        options, see autoencoder.build_autoencoder_from_config
+    importance_data: rows to score the importance on, train_data when None
+    repeat: passes over train_data per epoch (see fit_autoencoder)
+    convergence: ranking convergence settings, see get_feature_importances
+    """
+    training = training or {}
+    timings = {}
+    start = time.perf_counter()
+    learning_rate = scaled_learning_rate(optimizer, batch_size, training.get('base_batch_size'),
+                                         training.get('lr_scaling', 'none'))
+    autoencoder = build_autoencoder(train_data.shape[1], ratios, hidden_activation, dropout, optimizer, loss,
+                                    learning_rate, training.get('jit_compile', False),
+                                    training.get('steps_per_execution', 1))
+    history = fit_autoencoder(autoencoder, train_data, val_data, epochs, batch_size, repeat=repeat)
+    timings['train'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    importance_data = train_data if importance_data is None else importance_data
+    with instrument('importance', len(importance_data)):
+        importances = get_feature_importances(autoencoder, importance_data,
+                                              [method] if isinstance(method, str) else method, fpi_params, convergence)
+    timings['importance'] = time.perf_counter() - start
+    return autoencoder, history, importances, timings
+
+@contextmanager
+def thread_env(threads):
+    """
+    Pin the thread pools of the worker processes spawned inside the block
+
+    Spawned workers import this module, and with it TensorFlow, while unpickling
+    their initializer, so the OpenMP and TensorFlow variables only take effect
+    when they are already in the environment the worker inherits.
+    """
+    values = {'OMP_NUM_THREADS': str(threads), 'TF_NUM_INTRAOP_THREADS': str(threads), 'TF_NUM_INTEROP_THREADS': '1'}
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def pin_threads(threads):
+    """Limit the TensorFlow thread pools of a worker process started under thread_env"""
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _train_and_score_worker(model_path, *args):
+    """Run train_and_score in a worker and hand the model and stage measurements back"""
+    autoencoder, history, importances, timings = train_and_score(*args)
+    autoencoder.save(model_path)
+    return history.history, importances, timings, stage_records()
+
+def _train_and_score_parallel(jobs, threads):
+    """
+    Run one train_and_score job per worker process at the same time
     
-    # Build and train non-fraud autoencoder
-    autoencoder_NF = build_autoencoder(dev_NF.shape[1], ratios, hidden_activation, dropout, optimizer, loss)
-    history_NF = autoencoder_NF.fit(
-        dev_NF, dev_NF,
-        epochs=epochs,
-        batch_size=batch_size,
-        validation_data=(oos_NF, oos_NF)
-    )
+    Args:
+        jobs: list of argument tuples for train_and_score
+        threads: list with the number of threads pinned to each worker
+    """
+    tmp_dir = tempfile.mkdtemp()
+    executors, futures = [], []
+    try:
+        for i, (args, n_threads) in enumerate(zip(jobs, threads)):
+            # The worker process is spawned on submit
+            with thread_env(n_threads):
+                executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=pin_threads, initargs=(n_threads,))
+                model_path = os.path.join(tmp_dir, f'autoencoder_{i}.keras')
+                executors.append(executor)
+                futures.append((model_path, executor.submit(_train_and_score_worker, model_path, *args)))
+
+        results = []
+        for model_path, future in futures:
+            history_dict, importances, timings, records = future.result()
+            add_stage_records(records)
+            history = History()
+            history.history = history_dict
+            results.append((load_model(model_path), history, importances, timings))
+        return results
+    finally:
+        for executor in executors:
+            executor.shutdown()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def feature_selection_cache_path(cache_dir, data_key, ae_config, fpi_params, sampling=None):
+    """
+    Directory caching the trained autoencoders and importances for one data/config pair
     
-    # Get importance scores using both methods
-    importance_F = get_feature_importance(autoencoder_F, dev_F, method)
-    importance_NF = get_feature_importance(autoencoder_NF, dev_NF, method)
+    The key hashes the preprocessing artifact key, the autoencoder config, the FPI and
+    the sampling settings, so runs that only change feature_threshold or the selection
+    method reuse the autoencoders. Each method's importances are stored on their own
+    (importances_<method>.npz) and added the first time that method is asked for.
+    """
+    key = hashlib.md5(json.dumps({'data': data_key, 'autoencoder': ae_config, 'fpi': fpi_params, 'sampling': sampling},
+                                 sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, 'feature selection', key)
+
+def save_feature_selection_cache(cache_path, autoencoder_F, autoencoder_NF, history_F, history_NF):
+    """Cache the trained autoencoders and their histories; history.json is written last and marks a complete entry"""
+    tmp_path = cache_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    autoencoder_F.save(os.path.join(tmp_path, 'autoencoder_F.keras'))
+    autoencoder_NF.save(os.path.join(tmp_path, 'autoencoder_NF.keras'))
+    with open(os.path.join(tmp_path, 'history.json'), 'w') as f:
+        json.dump({'F': history_F.history, 'NF': history_NF.history}, f, default=float)
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.replace(tmp_path, cache_path)
+
+def load_feature_selection_cache(cache_path):
+    """The cached (autoencoder, history) pairs of the fraud and non-fraud autoencoders"""
+    with open(os.path.join(cache_path, 'history.json'), 'r') as f:
+        histories = json.load(f)
+    results = []
+    for prefix in ('F', 'NF'):
+        history = History()
+        history.history = histories[prefix]
+        results.append((load_model(os.path.join(cache_path, f'autoencoder_{prefix}.keras')), history))
+    return results
+
+def save_cached_importances(cache_path, method, importances_F, importances_NF):
+    """Add one method's importances (and convergence) of both autoencoders to the cache"""
+    path = os.path.join(cache_path, f'importances_{method}.npz')
+    keys = (method, f'{method}_convergence')
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **{f'F_{m}': v for m, v in importances_F.items() if m in keys},
+                 **{f'NF_{m}': v for m, v in importances_NF.items() if m in keys})
+    os.replace(path + '.tmp', path)
+
+def load_cached_importances(cache_path, method):
+    """The cached (fraud, non-fraud) importance dicts of one method, None when it was never computed"""
+    path = os.path.join(cache_path, f'importances_{method}.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        importances = {name: saved[name] for name in saved.files}
+    return tuple({name[len(prefix) + 1:]: v for name, v in importances.items() if name.startswith(prefix + '_')}
+                 for prefix in ('F', 'NF'))
+
+def feature_selection(dev_F, dev_NF, oos_F, oos_NF, feature_names, method, feature_threshold, 
+                     ratios=[0.8,0.5,0.2], hidden_activation='relu', dropout=0.1, 
+                     optimizer='adam', loss='mse', epochs=10, batch_size=32, fpi_params=None,
+                     execution=None, training=None, cache_path=None, importance_NF=None, sampling=None,
+                     importance_methods=None):
+    """
+    Train the fraud and non-fraud autoencoders and pick the features to drop
     
-    # Save importance scores and plots for fraud
-    save_feature_importance(importance_F, feature_names, method, 'abnormal')
-    save_feature_importance(importance_NF, feature_names, method, 'normal')
-    plot_feature_importance(importance_F, feature_names, method, 'abnormal')
-    plot_feature_importance(importance_NF, feature_names, method, 'normal')
+    execution: {'mode': 'serial' or 'parallel', 'fraud_threads': int, 'nonfraud_threads': int}.
+        In parallel mode both autoencoders are trained and scored at the same time in
+        separate processes; a thread count of 0 means all cores left over by the other worker.
+    training: learning rate scaling and jit options passed to train_and_score.
+    cache_path: directory from feature_selection_cache_path. When set, the autoencoders
+        and the importances of method are cached there. Later runs with another
+        threshold reuse both; runs with another method reuse the autoencoders and only
+        compute (and cache) that method's importances.
+    importance_NF: non-fraud rows to score the importance on, dev_NF when None
+        (e.g. a subsample from sampling.sample_indices).
+    sampling: the fs_sampling settings. With 'fraud_batching': 'repeat' every fraud
+        epoch passes over the fraud rows until fraud_rows_per_epoch rows were seen, so
+        the tiny fraud set gets full steps_per_execution runs and enough updates. With
+        a sampling method set, the non-fraud importance ranking is checked for
+        convergence and written to feature selection/normal_<method>_convergence.csv.
+    importance_methods: the importance methods to compute, e.g. ['re', 'fpi'] (method is
+        always included). Several methods share one set of forward passes through
+        get_feature_importances, each is cached and saved, and method picks the features
+        to drop. None computes method only.
+    """
+    execution = execution or {'mode': 'serial'}
+    sampling = sampling or {}
+    methods = [method] + [m for m in (importance_methods or []) if m != method]
+    ae_params = (ratios, hidden_activation, dropout, optimizer, loss, epochs, batch_size, fpi_params, training)
+    fraud_repeat = 1
+    if sampling.get('fraud_batching', 'none') == 'repeat':
+        fraud_repeat = max(1, int(np.ceil(sampling.get('fraud_rows_per_epoch', 4096) / max(1, len(dev_F)))))
+    convergence = sampling.get('convergence') if sampling.get('method', 'none') != 'none' else None
+    jobs = [(dev_F, oos_F, methods) + ae_params + (None, fraud_repeat, None),
+            (dev_NF, oos_NF, methods) + ae_params + (importance_NF, 1, convergence)]
+
+    start = time.perf_counter()
+    if cache_path and os.path.exists(os.path.join(cache_path, 'history.json')):
+        (autoencoder_F, history_F), (autoencoder_NF, history_NF) = load_feature_selection_cache(cache_path)
+        importances = [{}, {}]
+        missing = []
+        for m in methods:
+            cached = load_cached_importances(cache_path, m)
+            if cached is None:
+                missing.append(m)
+            else:
+                importances[0].update(cached[0])
+                importances[1].update(cached[1])
+        timings = [{'train': 0.0, 'importance': 0.0}, {'train': 0.0, 'importance': 0.0}]
+        if not missing:
+            print(f"Autoencoders and {', '.join(methods)} importances loaded from {cache_path}.")
+            mode = 'cached'
+        else:
+            # Only the importances of the newly requested methods are computed on the cached autoencoders
+            print(f"Autoencoders loaded from {cache_path}, computing {', '.join(missing)} importances.")
+            for job_importances, job_timings, autoencoder, data, job_convergence in [
+                    (importances[0], timings[0], autoencoder_F, dev_F, None),
+                    (importances[1], timings[1], autoencoder_NF, dev_NF if importance_NF is None else importance_NF,
+                     convergence)]:
+                job_start = time.perf_counter()
+                with instrument('importance', len(data)):
+                    job_importances.update(get_feature_importances(autoencoder, data, missing, fpi_params,
+                                                                   job_convergence))
+                job_timings['importance'] = time.perf_counter() - job_start
+            for m in missing:
+                save_cached_importances(cache_path, m, *importances)
+            mode = 'cached autoencoders'
+        results = [(autoencoder_F, history_F, importances[0], timings[0]),
+                   (autoencoder_NF, history_NF, importances[1], timings[1])]
+    elif execution['mode'] == 'parallel':
+        cores = os.cpu_count() or 2
+        fraud_threads = execution.get('fraud_threads') or max(1, cores - (execution.get('nonfraud_threads') or 0))
+        nonfraud_threads = execution.get('nonfraud_threads') or max(1, cores - fraud_threads)
+        results = _train_and_score_parallel(jobs, [fraud_threads, nonfraud_threads])
+        mode = 'parallel'
+    elif execution['mode'] == 'serial':
+        results = [train_and_score(*args) for args in jobs]
+        mode = 'serial'
+    else:
+        raise ValueError("Unsupported execution mode. Use 'serial' or 'parallel'.")
+    (autoencoder_F, history_F, importances_F, timings_F), \
+    (autoencoder_NF, history_NF, importances_NF, timings_NF) = results
+    if cache_path and mode in ('serial', 'parallel'):
+        save_feature_selection_cache(cache_path, autoencoder_F, autoencoder_NF, history_F, history_NF)
+        for m in methods:
+            save_cached_importances(cache_path, m, importances_F, importances_NF)
+    importance_F, importance_NF = importances_F[method], importances_NF[method]
+
+    timings = {
+        'fraud_train': timings_F['train'],
+        'fraud_importance': timings_F['importance'],
+        'nonfraud_train': timings_NF['train'],
+        'nonfraud_importance': timings_NF['importance'],
+        'total': time.perf_counter() - start
+    }
+    print("-------------------------------------------------")
+    print(f"Autoencoder timings ({mode}):")
+    for name, seconds in timings.items():
+        print(f'{name} = {seconds:.2f}s')
+
+    for m in methods:
+        if f'{m}_convergence' in importances_NF:
+            save_importance_convergence(importances_NF[f'{m}_convergence'], m, 'normal',
+                                        (sampling.get('convergence') or {}).get('min_spearman', 0.9))
+        # Save importance scores and plots for fraud and non-fraud
+        save_feature_importance(importances_F[m], feature_names, m, 'abnormal')
+        save_feature_importance(importances_NF[m], feature_names, m, 'normal')
+        plot_feature_importance(importances_F[m], feature_names, m, 'abnormal')
+        plot_feature_importance(importances_NF[m], feature_names, m, 'normal')
     
     # Use reconstruction error method for feature selection
     features_to_drop = determine_features_to_drop(importance_F, importance_NF, feature_threshold)
     
     # Convert numeric indices to feature names before returning
     features_to_drop = [feature_names[idx] for idx in features_to_drop]
-    return features_to_drop, importance_NF, importance_F, history_F, history_NF, autoencoder_F, autoencoder_NF
+    return features_to_drop, importance_NF, importance_F, history_F, history_NF, autoencoder_F, autoencoder_NF, timings
 
 def determine_features_to_drop(importance_F, importance_NF, feature_threshold=0.1):
     top_features_NF = np.argsort(importance_NF)[-int(len(importance_NF) * feature_threshold):]
@@ -103,7 +452,41 @@ def determine_features_to_drop(importance_F, importance_NF, feature_threshold=0.
     features_to_drop = np.union1d(top_features_NF, bottom_features_F)
     return features_to_drop
 
+def load_features_to_drop(path='feature selection/features_dropped.txt'):
+    """
+    Read the dropped-feature list written by fs(), None when the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return [str(name) for name in ast.literal_eval(f.read().strip() or '[]')]
+
+def feature_indices(features_to_drop, all_features):
+    """
+    Integer indices of the columns kept after dropping features_to_drop
+    """
+    unknown = set(features_to_drop) - set(all_features)
+    if unknown:
+        raise KeyError(f"{sorted(unknown)} not found in features")
+    dropped = set(features_to_drop)
+    return np.array([i for i, name in enumerate(all_features) if name not in dropped], dtype=np.intp)
+
+def select_columns(data, keep, rows=None):
+    """
+    Select the kept columns (and optionally rows) of a NumPy matrix as float32
+    
+    Returns a view when no rows are selected and the kept columns form a contiguous
+    range, otherwise a single gather with no intermediate copies.
+    """
+    data = np.asarray(data)
+    if rows is None and len(keep) and np.all(np.diff(keep) == 1):
+        selected = data[:, keep[0]:keep[-1] + 1]
+    elif rows is None:
+        selected = data.take(keep, axis=1)
+    else:
+        selected = data[np.ix_(rows, keep)]
+    return selected.astype(np.float32, copy=False)
+
 def drop_features(data, features_to_drop, all_features):
-    # Now features_to_drop contains column names, so we can use them directly
-    data = pd.DataFrame(data, columns=all_features)
-    return data.drop(columns=features_to_drop)
\ No newline at end of file
+    # Now features_to_drop contains column names, resolved once to column indices
+    return select_columns(data, feature_indices(features_to_drop, all_features))
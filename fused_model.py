@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+
+# Bump whenever the layout of the exported .npz changes
+FUSED_MODEL_VERSION = 2
+
+SELU_ALPHA = 1.6732632423543772
+SELU_SCALE = 1.0507009873554805
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'selu': lambda x: SELU_SCALE * np.where(x > 0, x, SELU_ALPHA * np.expm1(np.minimum(x, 0))),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x))
+}
+
+def _dense_layers(model):
+    """(W, b, activation) of every Dense layer of model, skipping Dropout (the identity at inference)"""
+    layers = []
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind == 'Dropout':
+            continue
+        if kind != 'Dense':
+            raise ValueError(f"Unsupported encoder layer {kind}. Only Dense and Dropout can be fused.")
+        activation = layer.get_config()['activation']
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Unsupported activation {activation}.")
+        W, b = [np.asarray(w, dtype=np.float64) for w in layer.get_weights()]
+        layers.append((W, b, activation))
+    return layers
+
+def export_fused_model(encoder, scaler, features_to_drop, logistic_model, threshold=0.5,
+                       path='saved best models/fused_model.npz', reconstruction_models=None):
+    """
+    Export scaler + encoder + logistic model as one NumPy artifact
+
+    Dropout layers are skipped (they are the identity at inference). The scaler and
+    the dropped features are folded into the first Dense layer: its weights are
+    divided by the feature scales, the means move into the bias and dropped
+    features get zero rows, so the artifact scores raw rows with all features.
+    reconstruction_models (autoencoders over all scaled features) are stored as is,
+    with the scaler, for the log1p reconstruction error features of build_feature_model.
+    """
+    feature_names = list(scaler.feature_names_in_)
+    dropped = set(features_to_drop)
+    keep = np.array([i for i, name in enumerate(feature_names) if name not in dropped], dtype=np.intp)
+    mean = np.zeros(len(feature_names)) if scaler.mean_ is None else scaler.mean_
+    scale = np.ones(len(feature_names)) if scaler.scale_ is None else scaler.scale_
+
+    arrays, activations = {}, []
+    for W, b, activation in _dense_layers(encoder):
+        if not activations:
+            W_full = np.zeros((len(feature_names), W.shape[1]))
+            W_full[keep] = W / scale[keep, None]
+            b = b - (mean[keep] / scale[keep]) @ W
+            W = W_full
+        arrays[f'W{len(activations)}'] = W.astype(np.float32)
+        arrays[f'b{len(activations)}'] = b.astype(np.float32)
+        activations.append(activation)
+
+    reconstruction_activations = []
+    for m, model in enumerate(reconstruction_models or []):
+        reconstruction_activations.append([])
+        for i, (W, b, activation) in enumerate(_dense_layers(model)):
+            arrays[f'R{m}_W{i}'] = W.astype(np.float32)
+            arrays[f'R{m}_b{i}'] = b.astype(np.float32)
+            reconstruction_activations[m].append(activation)
+    if reconstruction_activations:
+        arrays['mean'] = np.asarray(mean, dtype=np.float32)
+        arrays['scale'] = np.asarray(scale, dtype=np.float32)
+
+    meta = {
+        'version': FUSED_MODEL_VERSION,
+        'feature_names': feature_names,
+        'activations': activations,
+        'reconstruction_activations': reconstruction_activations,
+        'threshold': float(threshold)
+    }
+    np.savez(path, meta=np.array(json.dumps(meta)),
+             coef=logistic_model.coef_.ravel().astype(np.float32),
+             intercept=logistic_model.intercept_.astype(np.float32), **arrays)
+    return path
+
+class FusedModel:
+    """
+    Pure-NumPy scorer for an artifact written by export_fused_model
+
+    Takes raw (unscaled) rows with every column in feature_names order and never
+    imports TensorFlow.
+    """
+
+    def __init__(self, path='saved best models/fused_model.npz'):
+        with np.load(path) as artifact:
+            meta = json.loads(str(artifact['meta']))
+            if meta['version'] > FUSED_MODEL_VERSION:
+                raise ValueError(f"Fused model version {meta['version']} is not supported.")
+            self.layers = [(artifact[f'W{i}'], artifact[f'b{i}'], ACTIVATIONS[activation])
+                           for i, activation in enumerate(meta['activations'])]
+            # Version 1 artifacts have no reconstruction error features
+            self.reconstruction = [[(artifact[f'R{m}_W{i}'], artifact[f'R{m}_b{i}'], ACTIVATIONS[activation])
+                                    for i, activation in enumerate(activations)]
+                                   for m, activations in enumerate(meta.get('reconstruction_activations', []))]
+            if self.reconstruction:
+                self.mean, self.scale = artifact['mean'], artifact['scale']
+            self.coef = artifact['coef']
+            self.intercept = artifact['intercept'][0]
+        self.feature_names = meta['feature_names']
+        self.threshold = meta['threshold']
+
+    def encode(self, X):
+        """Logistic model inputs: the encoding, then the log1p reconstruction errors if the artifact has them"""
+        X = np.asarray(X, dtype=np.float32)
+        h = X
+        for W, b, activation in self.layers:
+            h = activation(h @ W + b)
+        if not self.reconstruction:
+            return h
+        scaled = (X - self.mean) / self.scale
+        errors = []
+        for layers in self.reconstruction:
+            r = scaled
+            for W, b, activation in layers:
+                r = activation(r @ W + b)
+            errors.append(np.log1p(np.mean((r - scaled) ** 2, axis=1, keepdims=True)))
+        return np.concatenate([h] + errors, axis=1)
+
+    def predict_proba(self, X):
+        """Fraud probability for each row"""
+        return 1 / (1 + np.exp(-(self.encode(X) @ self.coef + self.intercept)))
+
+    def predict(self, X):
+        return (self.predict_proba(X) > self.threshold).astype(int)
+
+def compare_with_keras(data_path, models_dir='saved best models', target_column='Class', repeats=5):
+    """
+    Parity and throughput check of the fused artifact against the Keras + sklearn path
+
+    Returns the largest absolute probability difference over the file and the rows/s
+    of both paths.
+    """
+    import joblib
+    import pandas as pd
+    from scoring import load_keras_encoder
+
+    fused = FusedModel(os.path.join(models_dir, 'fused_model.npz'))
+    X = pd.read_csv(data_path)[fused.feature_names].to_numpy(dtype=np.float32)
+    scaler = joblib.load(os.path.join(models_dir, 'scaler.pkl'))
+    logistic_model = joblib.load(os.path.join(models_dir, 'logistic_model.pkl'))
+    with open(os.path.join(models_dir, 'features_dropped.json'), 'r') as f:
+        dropped = set(json.load(f))
+    encoder, keep = load_keras_encoder(models_dir, [i for i, name in enumerate(fused.feature_names) if name not in dropped])
+
+    def keras_path(X):
+        scaled = scaler.transform(pd.DataFrame(X, columns=fused.feature_names))[:, keep]
+        return logistic_model.predict_proba(encoder.predict(scaled, batch_size=8192, verbose=0))[:, 1]
+
+    results = {'rows': len(X), 'max_abs_diff': float(np.abs(fused.predict_proba(X) - keras_path(X)).max())}
+    for name, score in [('keras', keras_path), ('fused', fused.predict_proba)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            score(X)
+        results[f'{name}_rows_per_sec'] = repeats * len(X) / (time.perf_counter() - start)
+    return results
+
+if __name__ == "__main__":
+    # python fused_model.py "input data/oot.csv": parity and throughput against the Keras path
+    print(compare_with_keras(sys.argv[1] if len(sys.argv) > 1 else 'input data/oot.csv'))
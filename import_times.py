@@ -0,0 +1,83 @@
+import os
+import sys
+import argparse
+import subprocess
+
+HEAVY_MODULES = ('tensorflow', 'keras', 'mlflow', 'sklearn', 'matplotlib', 'seaborn')
+
+# command: (module imported at its start-up, budget in ms, modules it must not import)
+IMPORT_CHECKS = {
+    'cli': ('cli', 100, HEAVY_MODULES),
+    'score --backend fused': ('scoring', 300, HEAVY_MODULES),
+    'batch-score': ('run_batch_score', 800, HEAVY_MODULES),
+    'profile': ('run_profile', 800, HEAVY_MODULES),
+    'bench': ('run_bench', 800, HEAVY_MODULES),
+    'encode': ('run_encode', 800, HEAVY_MODULES),
+}
+
+def import_times(module, repeats=3):
+    """
+    Cumulative import time in ms of module and of everything it imports, from python -X importtime
+
+    Each repeat runs in a fresh interpreter; the fastest run is kept to damp noise.
+    Returns {module name: cumulative ms}.
+    """
+    best = None
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                   capture_output=True, text=True, check=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        times = {}
+        for line in completed.stderr.splitlines():
+            # "import time: self [us] | cumulative | imported package"
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative) / 1000
+        if best is None or times[module] < best[module]:
+            best = times
+    return best
+
+def check_imports(checks=IMPORT_CHECKS, repeats=3, slack=1.0):
+    """
+    Import time of every command's start-up module against its budget (times slack) and its forbidden modules
+
+    Returns one dict per command with the time, the budget, the forbidden modules
+    that were imported, the slowest top-level imports and whether the check passed.
+    """
+    results = []
+    for command, (module, budget_ms, forbidden) in checks.items():
+        times = import_times(module, repeats)
+        imported = sorted(name for name in forbidden if name in times)
+        # Top-level packages, e.g. pandas rather than its submodules
+        slowest = sorted(((name, ms) for name, ms in times.items() if name != module and '.' not in name),
+                         key=lambda item: -item[1])[:5]
+        results.append({
+            'command': command,
+            'module': module,
+            'import_ms': times[module],
+            'budget_ms': budget_ms * slack,
+            'heavy_imports': imported,
+            'slowest': slowest,
+            'passed': times[module] <= budget_ms * slack and not imported
+        })
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the start-up import time of the lightweight commands")
+    parser.add_argument("--repeats", type=int, default=3, help="fresh interpreters per module, the fastest is kept")
+    parser.add_argument("--slack", type=float, default=1.0, help="multiply the budgets, e.g. on slower machines")
+    args = parser.parse_args(argv)
+
+    results = check_imports(repeats=args.repeats, slack=args.slack)
+    for result in results:
+        status = 'ok' if result['passed'] else 'REGRESSION'
+        print(f"{result['command']:<24}{result['import_ms']:8.0f} ms (budget {result['budget_ms']:.0f} ms)  {status}")
+        if result['heavy_imports']:
+            print(f"    imports {', '.join(result['heavy_imports'])}")
+        if not result['passed']:
+            print("    slowest: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in result['slowest']))
+    return 0 if all(result['passed'] for result in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import os
+import time
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# Set to a directory to dump a cProfile .prof file per instrumented stage
+PROFILE_DIR_ENV = 'PIPELINE_PROFILE_DIR'
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, 0 when it cannot be read"""
+    try:
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss) / 1024 ** 2
+    except ImportError:
+        return 0
+
+_records = []
+_lock = threading.Lock()
+
+def record_stage(stage, wall_seconds, cpu_seconds=None, rows=None):
+    """Store one stage measurement and write it to the Python log"""
+    record = {
+        'stage': stage,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'pid': os.getpid(),
+        'rows': rows,
+        'rows_per_sec': rows / wall_seconds if rows and wall_seconds else None
+    }
+    add_stage_records([record])
+    return record
+
+def add_stage_records(records):
+    """Store measurements, including ones taken in another process (e.g. a feature selection worker), and log them"""
+    with _lock:
+        _records.extend(records)
+    for record in records:
+        logging.info(f"Stage {record['stage']}: wall={record['wall_seconds']:.3f}s"
+                     + (f", cpu={record['cpu_seconds']:.3f}s" if record['cpu_seconds'] is not None else '')
+                     + f", peak_rss={record['peak_rss_mb']:.0f}MB (pid {record['pid']})"
+                     + (f", rows={record['rows']}, rows/s={record['rows_per_sec']:.0f}" if record['rows_per_sec'] else ''))
+
+def stage_records():
+    with _lock:
+        return list(_records)
+
+def reset_stage_records():
+    with _lock:
+        _records.clear()
+
+@contextmanager
+def instrument(stage, rows=None):
+    """
+    Measure wall time, CPU time, peak RSS and rows/sec of the enclosed block
+
+    Yields a dict whose 'rows' can be set inside the block once the row count is
+    known. CPU time is process-wide, so it overlaps for stages running concurrently
+    in threads, and peak RSS is the process peak at the end of the stage. When the
+    PIPELINE_PROFILE_DIR environment variable is set, the block is also profiled with
+    cProfile and dumped to <dir>/<stage>_<pid>_<n>.prof (open with pstats or snakeviz).
+    """
+    measurement = {'rows': rows}
+    profile_dir = os.environ.get(PROFILE_DIR_ENV)
+    profiler = None
+    if profile_dir:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can be active at a time; concurrent stages go unprofiled
+            profiler = None
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield measurement
+    finally:
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, f'{stage}_{os.getpid()}_{len(stage_records())}.prof'))
+        record_stage(stage, wall, cpu, measurement['rows'])
@@ -1,13 +1,190 @@
 import mlflow
-import mlflow.keras
+from mlflow.entities import Metric, Param, RunTag
 from mlflow.tracking import MlflowClient
 import os
+import json
+import time
+import queue
+import logging
+import tempfile
+import threading
+import urllib.request
 import pandas as pd
+from prepare_data import file_md5
 
-def init_mlflow(experiment_name="Feature_Selection_Pipeline"):
-    """Initialize MLflow experiment"""
-    mlflow.set_tracking_uri("http://localhost:5000")
+TRACKING_URI = "http://localhost:5000"
+# `mlflow ui` serves ./mlruns, so runs logged here while the server is down show up once it is back
+LOCAL_TRACKING_URI = "file:" + os.path.abspath("mlruns")
+
+def tracking_server_available(uri=TRACKING_URI, timeout=2.0):
+    """True if the MLflow server at uri answers on its /health endpoint"""
+    try:
+        with urllib.request.urlopen(uri.rstrip('/') + '/health', timeout=timeout) as response:
+            return response.status == 200
+    except (OSError, ValueError):
+        return False
+
+def init_mlflow(experiment_name="Feature_Selection_Pipeline", tracking_uri=TRACKING_URI):
+    """Initialize MLflow experiment, falling back to the local file store when the server is unreachable"""
+    if tracking_uri.startswith('http') and not tracking_server_available(tracking_uri):
+        logging.warning(f"MLflow server {tracking_uri} is unreachable, logging to {LOCAL_TRACKING_URI}")
+        print(f"MLflow server {tracking_uri} is unreachable, logging to {LOCAL_TRACKING_URI}")
+        tracking_uri = LOCAL_TRACKING_URI
+        # Newer MLflow releases refuse the file store unless it is explicitly allowed
+        os.environ.setdefault('MLFLOW_ALLOW_FILE_STORE', 'true')
+    mlflow.set_tracking_uri(tracking_uri)
     experiment = mlflow.get_experiment_by_name(experiment_name)
     if experiment is None:
         mlflow.create_experiment(experiment_name)
     mlflow.set_experiment(experiment_name)
+
+class AsyncLogger:
+    """
+    Queue MLflow logging calls to a background thread
+
+    Params, metrics and tags are buffered and sent with one log_batch call per flush
+    (at most every flush_interval seconds), artifacts and models are uploaded in
+    the same worker, so the caller never waits on the tracking server. Failed calls
+    are logged and dropped instead of failing the run. Use as a context manager
+    inside mlflow.start_run(); leaving it waits for the queue to drain.
+
+    log_dataset() uploads a file only the first time its content is seen by this
+    tracking server and otherwise tags the run with the URI of the earlier upload.
+    """
+
+    def __init__(self, run_id=None, flush_interval=1.0, dataset_index='cached data/mlflow_datasets.json'):
+        self.run_id = run_id or mlflow.active_run().info.run_id
+        self.client = MlflowClient()
+        self.flush_interval = flush_interval
+        self.dataset_index = dataset_index
+        self._queue = queue.Queue()
+        self._metrics, self._params, self._tags = [], [], []
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def log_param(self, key, value):
+        self._queue.put(('param', Param(key, str(value))))
+
+    def log_params(self, params):
+        for key, value in params.items():
+            self.log_param(key, value)
+
+    def log_metric(self, key, value, step=None):
+        self._queue.put(('metric', Metric(key, float(value), int(time.time() * 1000), step or 0)))
+
+    def log_metrics(self, metrics, step=None):
+        for key, value in metrics.items():
+            self.log_metric(key, value, step)
+
+    def log_stage_records(self, records):
+        """Log instrumentation records as stage_<name>_<measure> metrics, one step per repeat of a stage"""
+        steps = {}
+        for record in records:
+            step = steps[record['stage']] = steps.get(record['stage'], -1) + 1
+            for measure in ('wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'rows_per_sec'):
+                if record[measure] is not None:
+                    self.log_metric(f"stage_{record['stage']}_{measure}", record[measure], step)
+
+    def set_tag(self, key, value):
+        self._queue.put(('tag', (key, str(value))))
+
+    def log_artifact(self, local_path, artifact_path=None):
+        self._queue.put(('call', (self.client.log_artifact, (self.run_id, local_path, artifact_path))))
+
+    def log_text(self, text, artifact_file):
+        self._queue.put(('call', (self.client.log_text, (self.run_id, text, artifact_file))))
+
+    def log_model(self, save_model, model, artifact_path):
+        """save_model is a flavor's save function such as mlflow.keras.save_model"""
+        def call():
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                save_model(model, os.path.join(tmp_dir, 'model'))
+                self.client.log_artifacts(self.run_id, os.path.join(tmp_dir, 'model'), artifact_path)
+        call.__name__ = f'log_model({artifact_path})'
+        self._queue.put(('call', (call, ())))
+
+    def log_child_run(self, run_name, params=None, metrics=None):
+        """Log a finished nested run (e.g. one search trial) under this run in one request"""
+        def call():
+            parent = self.client.get_run(self.run_id)
+            child = self.client.create_run(parent.info.experiment_id, run_name=run_name,
+                                           tags={'mlflow.parentRunId': self.run_id})
+            timestamp = int(time.time() * 1000)
+            self.client.log_batch(child.info.run_id,
+                                  metrics=[Metric(k, float(v), timestamp, 0) for k, v in (metrics or {}).items()],
+                                  params=[Param(k, str(v)) for k, v in (params or {}).items()])
+            self.client.set_terminated(child.info.run_id)
+        call.__name__ = f'log_child_run({run_name})'
+        self._queue.put(('call', (call, ())))
+
+    def log_dataset(self, local_path, artifact_path='datasets'):
+        self._queue.put(('call', (self._log_dataset, (local_path, artifact_path))))
+
+    def _log_dataset(self, local_path, artifact_path):
+        md5 = file_md5(local_path, os.path.dirname(self.dataset_index) or '.')
+        name = os.path.basename(local_path)
+        index = {}
+        if os.path.exists(self.dataset_index):
+            with open(self.dataset_index, 'r') as f:
+                index = json.load(f)
+        uploads = index.setdefault(mlflow.get_tracking_uri(), {})
+        if md5 not in uploads:
+            self.client.log_artifact(self.run_id, local_path, artifact_path)
+            run = self.client.get_run(self.run_id)
+            uploads[md5] = f"{run.info.artifact_uri}/{artifact_path}/{name}"
+            os.makedirs(os.path.dirname(self.dataset_index) or '.', exist_ok=True)
+            with open(self.dataset_index, 'w') as f:
+                json.dump(index, f, indent=4)
+        self._tags += [(f"{artifact_path}.{name}.md5", md5), (f"{artifact_path}.{name}.uri", uploads[md5])]
+
+    def _flush(self):
+        if not (self._metrics or self._params or self._tags):
+            return
+        # log_batch accepts at most 1000 metrics and 100 params/tags per request
+        while self._metrics or self._params or self._tags:
+            metrics, self._metrics = self._metrics[:1000], self._metrics[1000:]
+            params, self._params = self._params[:100], self._params[100:]
+            tags, self._tags = self._tags[:100], self._tags[100:]
+            try:
+                self.client.log_batch(self.run_id, metrics=metrics, params=params,
+                                      tags=[RunTag(key, value) for key, value in tags])
+            except Exception as e:
+                logging.error(f"MLflow log_batch failed: {str(e)}")
+
+    def _run(self):
+        last_flush = time.perf_counter()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ('flush', None)
+            kind, payload = item
+            if kind == 'metric':
+                self._metrics.append(payload)
+            elif kind == 'param':
+                self._params.append(payload)
+            elif kind == 'tag':
+                self._tags.append(payload)
+            elif kind == 'call':
+                # Keep params/metrics ordered before the artifact that follows them
+                self._flush()
+                function, args = payload
+                try:
+                    function(*args)
+                except Exception as e:
+                    logging.error(f"MLflow call {getattr(function, '__name__', function)} failed: {str(e)}")
+            if kind in ('flush', 'close') or time.perf_counter() - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = time.perf_counter()
+            if kind == 'close':
+                return
+
+    def close(self):
+        self._queue.put(('close', None))
+        self._worker.join()
@@ -1,32 +1,62 @@
 import pandas as pd
 from sklearn.model_selection import GridSearchCV
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import f1_score, precision_score, recall_score, confusion_matrix
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 import joblib
+import json
+import logging
 import numpy as np
 import os
+from fused_model import export_fused_model
+from instrumentation import instrument
+from sampling import reservoir_sample
 
 
-def train_model(X_train, y_train, X_test, y_test, model_type, params, threshold):
-
+def train_model(X_train, y_train, X_test, y_test, model_type, params, threshold, model=None):
+    """
+    Fit the model and score it on the test set
+    
+    threshold: a fixed probability cut-off, 'best_f1' for the F1-optimal cut-off on the
+        training scores (applied to the test set), or 0 for the percentile matching the
+        training fraud rate.
+    model: an already fitted model to continue from (warm_start) instead of a new one.
+    Returns the model, f1, precision, recall, confusion matrix and predictions at the
+    chosen threshold, the threshold, and a dict with the PR-AUC and the best F1 threshold
+    on the test scores (a diagnostic, optimistic by construction).
+    """
     percentile = (1-y_train.mean()) * 100
 
-    model = LogisticRegression() if model_type == 'LogisticRegression' else None
-    if model is None:
-        raise ValueError("Unsupported model type. Only LogisticRegression is supported.")
-    model.set_params(**params)
-    model.fit(X_train, y_train)
-    
-    if threshold:
-        threshold = threshold
+    if model is not None:
+        # Start the solver from the fitted coefficients
+        model.set_params(warm_start=True)
     else:
-        threshold = np.percentile(model.predict_proba(X_test)[:, 1], percentile)
+        model = LogisticRegression() if model_type == 'LogisticRegression' else None
+        if model is None:
+            raise ValueError("Unsupported model type. Only LogisticRegression is supported.")
+        model.set_params(**params)
+    with instrument('logistic_fit', len(X_train)):
+        model.fit(X_train, y_train)
+    
+    if threshold == 'best_f1':
+        threshold = threshold_sweep(y_train, model.predict_proba(X_train)[:, 1])['best_threshold']
+    scores = model.predict_proba(X_test)[:, 1]
+    return (model,) + evaluate_scores(scores, y_test, threshold, percentile)
+
+def evaluate_scores(scores, y_test, threshold, percentile):
+    """
+    Metrics of test scores at the threshold setting of train_model; also writes predictions/predictions.csv
+
+    'best_f1' must already be resolved to a cut-off from the training scores, so the
+    test rows never pick their own threshold.
+    Returns f1, precision, recall, confusion matrix, predictions, the threshold and the curve metrics.
+    """
+    if threshold == 'best_f1':
+        raise ValueError("Resolve the best_f1 threshold on the training scores before evaluating.")
+    sweep = threshold_sweep(y_test, scores)
+    if not threshold:
+        threshold = np.percentile(scores, percentile)
     
     # Ensure predictions are discrete class labels
-    if hasattr(model, 'predict_proba'):
-        y_pred = (model.predict_proba(X_test)[:, 1] > threshold).astype(int)
-    else:
-        y_pred = model.predict(X_test)
+    y_pred = (scores > threshold).astype(int)
 
     # Saving csv file of predictions on test data
     if not os.path.exists('predictions'):
@@ -34,16 +64,216 @@ def train_model(X_train, y_train, X_test, y_test, model_type, params, threshold)
     predictions_df = pd.DataFrame({'Predictions': y_pred})
     predictions_df.to_csv('predictions/predictions.csv', index=False)
     
-    f1 = f1_score(y_test, y_pred)
-    precision = precision_score(y_test, y_pred)
-    recall = recall_score(y_test, y_pred)
-    confusion_mat = confusion_matrix(y_test, y_pred)
-    return model, f1, precision, recall, confusion_mat, predictions_df
-
-def save_results(encoded_dev, encoded_oos, encoded_oot, autoencoder_model, encoder_model, logistic_model):
-    pd.DataFrame(encoded_dev).to_csv('encoded data/encoded_dev.csv', index=False)
-    pd.DataFrame(encoded_oos).to_csv('encoded data/encoded_oos.csv', index=False)
-    pd.DataFrame(encoded_oot).to_csv('encoded data/encoded_oot.csv', index=False)
+    f1, precision, recall, confusion_mat = metrics_at_threshold(sweep, threshold)
+    curve_metrics = {'pr_auc': sweep['pr_auc'], 'best_f1': sweep['best_f1'],
+                     'best_threshold': sweep['best_threshold']}
+    return f1, precision, recall, confusion_mat, predictions_df, threshold, curve_metrics
+
+def iterate_chunks(sources, chunk_rows, rng=None):
+    """
+    (features, target) chunks of at most chunk_rows rows over a list of (features, target) sources
+
+    Sources may be memory-mapped arrays (stage outputs or load_encoded files), and only
+    one chunk is read into memory at a time. With an rng, the chunks are visited in a
+    random order and the rows of each chunk are shuffled.
+    """
+    chunks = [(i, start) for i, (features, _) in enumerate(sources) for start in range(0, len(features), chunk_rows)]
+    if rng is not None:
+        chunks = [chunks[i] for i in rng.permutation(len(chunks))]
+    for i, start in chunks:
+        features, target = sources[i]
+        X = np.asarray(features[start:start + chunk_rows], dtype=np.float32)
+        y = np.asarray(target[start:start + chunk_rows]).astype(np.int64)
+        if rng is not None:
+            order = rng.permutation(len(y))
+            X, y = X[order], y[order]
+        yield X, y
+
+def sample_rows(sources, k, seed=42):
+    """Uniform sample of k rows of the sources as in-memory (features, target), drawn in one streaming pass"""
+    n_rows = sum(len(target) for _, target in sources)
+    offsets = np.cumsum([0] + [len(target) for _, target in sources])
+    chunks = (np.arange(start, min(start + 65536, n_rows)) for start in range(0, n_rows, 65536))
+    positions = np.sort(reservoir_sample(chunks, min(k, n_rows), seed))
+    X, y = [], []
+    for i, (features, target) in enumerate(sources):
+        rows = positions[(positions >= offsets[i]) & (positions < offsets[i + 1])] - offsets[i]
+        X.append(np.asarray(features[rows], dtype=np.float32))
+        y.append(np.asarray(target[rows]).astype(np.int64))
+    return np.concatenate(X), np.concatenate(y)
+
+def predict_in_chunks(model, X, chunk_rows):
+    """Fraud probabilities of X, chunk_rows rows at a time"""
+    return np.concatenate([model.predict_proba(np.asarray(X[start:start + chunk_rows], dtype=np.float32))[:, 1]
+                           for start in range(0, len(X), chunk_rows)] or [np.empty(0)])
+
+def train_model_out_of_core(sources, X_test, y_test, params, threshold, settings, model=None):
+    """
+    Fit an SGD logistic regression chunk by chunk over the training sources and score it on the test set
+
+    sources: (features, target) pairs, e.g. the memory-mapped dev and oos encodings;
+        they are never concatenated, so memory follows settings['chunk_rows'] and not
+        the number of training rows.
+    params: the LogisticRegression params. Without settings['alpha'], the L2 penalty is
+        1 / (C * rows), the same objective as the lbfgs fit with the same class weights.
+    settings: the out_of_core section; 'class_weight' is 'balanced' (weights from the
+        label counts of a first pass over the targets), a {label: weight} dict, or null
+        for the class_weight of params (none by default, as in the lbfgs fit).
+        With settings['parity_rows'], an lbfgs LogisticRegression with params and the
+        SGD model's class weights is also fitted on a uniform sample of that many rows
+        and both PR-AUCs are compared on the test set (curve_metrics['parity']).
+    model: a fitted SGDClassifier to continue with partial_fit instead of a new one.
+    Returns the same values as train_model.
+    """
+    counts = np.zeros(2, dtype=np.int64)
+    for _, target in sources:
+        for start in range(0, len(target), 1 << 20):
+            counts += np.bincount(np.asarray(target[start:start + (1 << 20)]).astype(np.int64), minlength=2)[:2]
+    n_rows = int(counts.sum())
+    percentile = counts[0] / n_rows * 100
+
+    if model is None:
+        class_weight = settings.get('class_weight') or params.get('class_weight')
+        if class_weight == 'balanced':
+            # As in sklearn; partial_fit needs the weights up front
+            class_weight = {label: n_rows / (2 * count) for label, count in enumerate(counts.tolist()) if count}
+        elif class_weight:
+            class_weight = {int(label): weight for label, weight in class_weight.items()}
+        alpha = settings.get('alpha') or 1 / (params.get('C', 1.0) * n_rows)
+        model = SGDClassifier(loss='log_loss', penalty='l2', alpha=alpha, class_weight=class_weight,
+                              learning_rate=settings.get('learning_rate', 'optimal'), eta0=settings.get('eta0', 0.01),
+                              average=settings.get('average', True), random_state=params.get('random_state'))
+    rng = np.random.default_rng(params.get('random_state'))
+    with instrument('logistic_fit', n_rows * settings.get('epochs', 5)):
+        for epoch in range(settings.get('epochs', 5)):
+            for X, y in iterate_chunks(sources, settings.get('chunk_rows', 262144), rng):
+                model.partial_fit(X, y, classes=np.array([0, 1]))
+
+    if threshold == 'best_f1':
+        # Tuned on the training sources, one chunk at a time
+        train_scores = np.concatenate([predict_in_chunks(model, features, settings.get('chunk_rows', 262144))
+                                       for features, _ in sources])
+        y_train = np.concatenate([np.asarray(target).astype(np.int64) for _, target in sources])
+        threshold = threshold_sweep(y_train, train_scores)['best_threshold']
+    scores = predict_in_chunks(model, X_test, settings.get('chunk_rows', 262144))
+    results = evaluate_scores(scores, y_test, threshold, percentile)
+    if settings.get('parity_rows'):
+        # The reference optimizes the same weighted objective as the SGD model
+        results[-1]['parity'] = lbfgs_parity(sources, X_test, y_test, dict(params, class_weight=model.class_weight),
+                                             results[-1]['pr_auc'], settings)
+    return (model,) + results
+
+def lbfgs_parity(sources, X_test, y_test, params, pr_auc, settings):
+    """
+    PR-AUC of an lbfgs LogisticRegression fitted on a sample of settings['parity_rows'] rows
+    against the out-of-core model's; logs a warning above settings['parity_tolerance']
+    """
+    X_sample, y_sample = sample_rows(sources, settings['parity_rows'], params.get('random_state') or 42)
+    reference = LogisticRegression(**params).fit(X_sample, y_sample)
+    reference_pr_auc = threshold_sweep(y_test, predict_in_chunks(reference, X_test,
+                                                                 settings.get('chunk_rows', 262144)))['pr_auc']
+    parity = {'rows': len(y_sample), 'pr_auc_lbfgs': reference_pr_auc, 'pr_auc_sgd': pr_auc,
+              'difference': pr_auc - reference_pr_auc}
+    print(f"Out-of-core PR-AUC {pr_auc:.4f} vs lbfgs {reference_pr_auc:.4f} on {len(y_sample)} rows")
+    if parity['difference'] < -settings.get('parity_tolerance', 0.01):
+        logging.warning(f"Out-of-core model PR-AUC {pr_auc:.4f} is below the lbfgs fit ({reference_pr_auc:.4f}); "
+                        f"consider more out_of_core.epochs or a different learning_rate.")
+    return parity
+
+def threshold_sweep(y_true, scores):
+    """
+    Precision, recall and F1 at every candidate threshold from one sort of the scores
+    
+    Candidates are the distinct scores. True and false positive counts for all of them
+    come from cumulative sums over the labels in descending score order, which also
+    gives the F1-optimal threshold and the PR-AUC (average precision) in the same pass.
+    thresholds[k] is chosen so that scores > thresholds[k] selects every row scoring at
+    least the k-th largest distinct score.
+    """
+    y_true = np.asarray(y_true).astype(np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(scores, kind='stable')[::-1]
+    sorted_scores = scores[order]
+    tp_cum = np.cumsum(y_true[order])
+    fp_cum = np.arange(1, len(order) + 1) - tp_cum
+    positives = tp_cum[-1] if len(order) else 0
+
+    # Last position of each run of equal scores
+    last = np.r_[np.flatnonzero(np.diff(sorted_scores)), len(order) - 1]
+    tps, fps = tp_cum[last], fp_cum[last]
+    precision = tps / (tps + fps)
+    recall = tps / positives if positives else np.zeros(len(tps))
+    f1 = 2 * tps / np.maximum(tps + fps + positives, 1)
+    pr_auc = float(np.sum(np.diff(np.r_[0, recall]) * precision))
+    best = int(np.argmax(f1))
+    thresholds = np.nextafter(sorted_scores[last], -np.inf)
+    return {
+        'sorted_scores': sorted_scores,
+        'tp_cum': tp_cum,
+        'positives': int(positives),
+        'thresholds': thresholds,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'pr_auc': pr_auc,
+        'best_f1': float(f1[best]),
+        'best_threshold': float(thresholds[best])
+    }
+
+def metrics_at_threshold(sweep, threshold):
+    """
+    f1, precision, recall and confusion matrix for predictions scores > threshold,
+    read off a threshold_sweep without scanning the labels again
+    """
+    n = len(sweep['sorted_scores'])
+    # Scores are in descending order, so the predicted positives are a prefix
+    predicted = int(np.searchsorted(-sweep['sorted_scores'], -threshold, side='left'))
+    tp = int(sweep['tp_cum'][predicted - 1]) if predicted else 0
+    fp = predicted - tp
+    fn = sweep['positives'] - tp
+    tn = n - predicted - fn
+    precision = tp / predicted if predicted else 0.0
+    recall = tp / sweep['positives'] if sweep['positives'] else 0.0
+    f1 = 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+    return f1, precision, recall, np.array([[tn, fp], [fn, tp]])
+
+def save_results(autoencoder_model, encoder_model, logistic_model, scaler=None, features_to_drop=None, threshold=None,
+                 reconstruction_models=None):
+    """
+    Save the final models for scoring
+
+    reconstruction_models: the fraud and non-fraud autoencoders when the logistic model
+        also takes their reconstruction errors. They are saved as autoencoder_F/NF.keras
+        next to feature_model.keras, the single model from all scaled features to the
+        logistic model inputs (see autoencoder.build_feature_model).
+    """
+    feature_files = ['autoencoder_F.keras', 'autoencoder_NF.keras', 'feature_model.keras']
+    if reconstruction_models:
+        from autoencoder import build_feature_model
+
+        feature_names = list(scaler.feature_names_in_)
+        dropped = set(features_to_drop or [])
+        keep = [i for i, name in enumerate(feature_names) if name not in dropped]
+        for name, model in zip(feature_files, list(reconstruction_models) +
+                               [build_feature_model(autoencoder_model, reconstruction_models, keep, len(feature_names))]):
+            model.save(os.path.join('saved best models', name))
+    else:
+        # Scorers use feature_model.keras whenever it exists, so a stale one must not be left behind
+        for name in feature_files:
+            if os.path.exists(os.path.join('saved best models', name)):
+                os.remove(os.path.join('saved best models', name))
     encoder_model.save('saved best models/encoder_model.h5')
     autoencoder_model.save('saved best models/autoencoder_model.h5')
-    joblib.dump(logistic_model, 'saved best models/logistic_model.pkl')
\ No newline at end of file
+    joblib.dump(logistic_model, 'saved best models/logistic_model.pkl')
+    if scaler is not None:
+        joblib.dump(scaler, 'saved best models/scaler.pkl')
+    if features_to_drop is not None:
+        with open('saved best models/features_dropped.json', 'w') as f:
+            json.dump(list(features_to_drop), f)
+    if threshold is not None:
+        with open('saved best models/model_threshold.json', 'w') as f:
+            json.dump({'threshold': float(threshold)}, f)
+    if scaler is not None:
+        export_fused_model(encoder_model, scaler, features_to_drop or [], logistic_model,
+                           0.5 if threshold is None else threshold, 'saved best models/fused_model.npz',
+                           reconstruction_models)
\ No newline at end of file
@@ -2,37 +2,64 @@ from prepare_data import *
 from feature_selection import *
 from autoencoder import *
 from model import *
+from stages import Stage, ArtifactStore, run_stages
+from encoded_storage import save_encoded
+from instrumentation import instrument
+from sampling import sample_indices
 import os
+import json
+import shutil
+import hashlib
+import joblib
 import seaborn as sns
 
-def fs(default_hyperparameters):
-    dev, oos, oot = load_data(default_hyperparameters["train_file"], 
-                            default_hyperparameters["validation_file"], 
-                            default_hyperparameters["test_file"])
-        
-    print("-------------------------------------------------")
-    print("Data loaded successfully.")
-    dev_scaled, oos_scaled, oot_scaled, scaler = standardize_data(dev, oos, oot)
-    print("-------------------------------------------------")
-    print("Data scaled successfully.")
-    feature_names = list(dev.drop(['Class'], axis=1).columns)
-    dev_F, dev_NF, oos_F, oos_NF = split_data(dev, oos)
+def preprocess_stage(hyperparameters):
+    data = preprocess_data(hyperparameters["train_file"],
+                           hyperparameters["validation_file"],
+                           hyperparameters["test_file"],
+                           hyperparameters["target_column"],
+                           hyperparameters["data_cache"])
     print("-------------------------------------------------")
-    print("Data split into fraud and non-fraud successfully.")
-    scaled_dev_F = scaler.transform(dev_F)
-    scaled_dev_NF = scaler.transform(dev_NF)
-    scaled_oos_F = scaler.transform(oos_F)
-    scaled_oos_NF = scaler.transform(oos_NF)
+    print("Data loaded, scaled and split into fraud and non-fraud successfully.")
+    return data
+
+def feature_selection_stage(default_hyperparameters, data):
+    feature_names = data['feature_names']
+    # Only the sampled non-fraud rows are gathered; every fraud row is kept
+    sampling = default_hyperparameters.get('fs_sampling') or {'method': 'none'}
+    seed = sampling.get('seed', 42)
+    dev_NF_idx = sample_indices(data['dev_scaled'], data['dev_NF_idx'], sampling.get('train_rows'), sampling,
+                                feature_names, seed)
+    importance_NF_idx = sample_indices(data['dev_scaled'], data['dev_NF_idx'], sampling.get('importance_rows'),
+                                       sampling, feature_names, seed + 1)
+    oos_NF_idx = sample_indices(data['oos_scaled'], data['oos_NF_idx'], sampling.get('validation_rows'), sampling,
+                                feature_names, seed + 2)
+    scaled_dev_F = data['dev_scaled'][data['dev_F_idx']]
+    scaled_dev_NF = data['dev_scaled'][dev_NF_idx]
+    scaled_oos_F = data['oos_scaled'][data['oos_F_idx']]
+    scaled_oos_NF = data['oos_scaled'][oos_NF_idx]
+    scaled_importance_NF = None
+    if sampling.get('method', 'none') != 'none':
+        scaled_importance_NF = data['dev_scaled'][importance_NF_idx]
+        print(f"Sampled ({sampling['method']}) {len(dev_NF_idx)} of {len(data['dev_NF_idx'])} non-fraud rows for "
+              f"training, {len(importance_NF_idx)} for importance and {len(oos_NF_idx)} for validation.")
 
     os.makedirs('feature selection', exist_ok=True)
     os.makedirs('figures', exist_ok=True)
 
+    # Trained autoencoders and importances are reused while the data and autoencoder config match
+    cache_path = None
+    if data['key'] is not None and default_hyperparameters.get('fs_cache', True):
+        cache_path = feature_selection_cache_path(default_hyperparameters['data_cache'], data['key'],
+                                                  default_hyperparameters['autoencoder'],
+                                                  default_hyperparameters['fpi'], sampling)
+
     # Perform feature selection
     print("-------------------------------------------------")
     print("Performing feature selection...")
     # Get both autoencoders and feature selection results
     features_to_drop, importance_scores_normal, importance_scores_abnormal, \
-    history_F, history_NF, autoencoder_F, autoencoder_NF = feature_selection(
+    history_F, history_NF, autoencoder_F, autoencoder_NF, timings = feature_selection(
         scaled_dev_F, scaled_dev_NF, scaled_oos_F, scaled_oos_NF,
         feature_names,
         default_hyperparameters['feature_selection'],
@@ -43,142 +70,426 @@ def fs(default_hyperparameters):
         default_hyperparameters['autoencoder']['optimizer'],
         default_hyperparameters['autoencoder']['loss'],
         default_hyperparameters['autoencoder']['epochs'],
-        default_hyperparameters['autoencoder']['batch_size']
+        default_hyperparameters['autoencoder']['batch_size'],
+        default_hyperparameters['fpi'],
+        default_hyperparameters['fs_execution'],
+        default_hyperparameters['autoencoder'],
+        cache_path,
+        scaled_importance_NF,
+        sampling,
+        default_hyperparameters.get('fs_importance_methods')
     )
-
-    with open('feature selection/features_dropped.txt', 'w') as f:
-        f.write(str(features_to_drop))
-    
     return {
         'features_dropped': features_to_drop,
-        'importance_scores_normal': importance_scores_normal,
-        'importance_scores_abnormal': importance_scores_abnormal,
-        'history_F': history_F,
-        'history_NF': history_NF,
+        'importance_scores_normal': np.asarray(importance_scores_normal),
+        'importance_scores_abnormal': np.asarray(importance_scores_abnormal),
+        'history_F': history_F.history,
+        'history_NF': history_NF.history,
         'autoencoder_F': autoencoder_F,
         'autoencoder_NF': autoencoder_NF,
-        'dev': dev,
-        'oos': oos,
-        'oot': oot,
+        'timings': timings,
         'feature_names': feature_names
     }
 
-def pipeline(hyperparameters):
-    dev, oos, oot = load_data(hyperparameters["train_file"], hyperparameters["validation_file"], hyperparameters["test_file"])
-    print("-------------------------------------------------")
-    print("Data loaded successfully.")
-    dev_scaled, oos_scaled, oot_scaled, scaler = standardize_data(dev, oos, oot)
+def autoencoder_stage(hyperparameters, data, features_to_drop):
+    keep = feature_indices(features_to_drop, data['feature_names'])
+    if hyperparameters['train_on'] == 'normal':
+        train_on = select_columns(data['dev_scaled'], keep, data['dev_NF_idx'])
+        val_on = select_columns(data['oos_scaled'], keep, data['oos_NF_idx'])
+    elif hyperparameters['train_on'] == 'abnormal':
+        train_on = select_columns(data['dev_scaled'], keep, data['dev_F_idx'])
+        val_on = train_on
+
     print("-------------------------------------------------")
-    print("Data scaled successfully.")
-    feature_names = list(dev.drop([hyperparameters["target_column"]], axis=1).columns)
-    dev_F, dev_NF, oos_F, oos_NF = split_data(dev, oos)
+    print("Training main autoencoder with dropped features..")
+    final_autoencoder = build_autoencoder_from_config(train_on.shape[1], hyperparameters['autoencoder'])
+    history_final = fit_autoencoder(final_autoencoder, train_on, val_on,
+                                    hyperparameters['autoencoder']['epochs'],
+                                    hyperparameters['autoencoder']['batch_size'])
+    print("Main autoencoder trained successfully.")
+    return {'autoencoder': final_autoencoder, 'history': history_final.history}
+
+def encoder_stage(hyperparameters, data, features_to_drop, autoencoder, reconstruction_models=None):
+    """
+    The model the encode stages run and the columns it takes (None for all of them)
+
+    Built once, before the encode stages fan out to threads: Keras models are not
+    safely built from the shared autoencoder layers concurrently. A one-row predict
+    also creates the predict function here rather than racing to in the threads.
+    """
+    keep = feature_indices(features_to_drop, data['feature_names'])
+    if reconstruction_models:
+        # Encoding and the reconstruction errors of the feature selection autoencoders in one pass
+        model = build_feature_model(autoencoder, reconstruction_models, keep, len(data['feature_names']))
+        keep = None
+    else:
+        model = Sequential(autoencoder.layers[:4])  # Extract encoder part
+    n_inputs = len(data['feature_names']) if keep is None else len(keep)
+    model.predict(np.zeros((1, n_inputs), dtype=np.float32), verbose=0)
+    return {'model': model, 'keep': keep}
+
+def encode_stage(hyperparameters, data, encoder, split):
+    # Columns are dropped inside encode_data, chunk by chunk when encode_chunk_size is set
+    encoded = encode_data(encoder['model'], data[f'{split}_scaled'], hyperparameters['encode_chunk_size'],
+                          encoder['keep'])
+    print(f"{split} data encoded successfully.")
+    return {'encoded': encoded}
+
+def model_stage(hyperparameters, data, encoded_dev, encoded_oos, encoded_oot):
     print("-------------------------------------------------")
-    print("Data split into fraud and non-fraud successfully.")
-    scaled_dev_F = scaler.transform(dev_F)
-    scaled_dev_NF = scaler.transform(dev_NF)
-    scaled_oos_F = scaler.transform(oos_F)
-    scaled_oos_NF = scaler.transform(oos_NF)
+    print("Training regression model...")
+    out_of_core = hyperparameters.get('out_of_core') or {}
+    train_splits = [(encoded_dev, data['y_dev']), (encoded_oos, data['y_oos'])]
+    if hyperparameters.get('reconstruction_features'):
+        # The feature selection autoencoders were trained on dev, so their reconstruction
+        # errors are in-sample there; the model is fitted on the oos rows they never saw
+        train_splits = train_splits[1:]
+        print(f"Reconstruction error features: fitting on the {len(encoded_oos)} oos rows only.")
+    if out_of_core.get('enabled'):
+        # Streams the (memory-mapped when cached) encodings instead of concatenating them
+        reg_model, f1, precision, recall, confusion_mat, predictions_df, threshold, curve_metrics = \
+            train_model_out_of_core(train_splits, encoded_oot, data['y_oot'], hyperparameters["model_params"],
+                                    hyperparameters["model_threshold"], out_of_core)
+    else:
+        X_train = np.concatenate([encoded for encoded, _ in train_splits])
+        y_train = np.concatenate([y for _, y in train_splits])
+        reg_model, f1, precision, recall, confusion_mat, predictions_df, threshold, curve_metrics = train_model(X_train,
+                                                            y_train, 
+                                                            encoded_oot, 
+                                                            data['y_oot'],
+                                                            hyperparameters["model"], 
+                                                            hyperparameters["model_params"],
+                                                            hyperparameters["model_threshold"])
+    print("Regression model trained successfully.")
+    return {
+        'reg_model': reg_model,
+        'f1': f1,
+        'precision': precision,
+        'recall': recall,
+        'confusion_matrix': confusion_mat,
+        'predictions_df': predictions_df,
+        'threshold': threshold,
+        'pr_auc': curve_metrics['pr_auc'],
+        'best_f1': curve_metrics['best_f1'],
+        'best_threshold': curve_metrics['best_threshold'],
+        'parity': curve_metrics.get('parity')
+    }
+
+def reconstruction_autoencoders(hyperparameters, selected):
+    """The feature selection autoencoders whose reconstruction errors become model features, if enabled"""
+    if not hyperparameters.get('reconstruction_features'):
+        return None
+    return [selected['autoencoder_F'], selected['autoencoder_NF']]
+
+def pipeline_stages(hyperparameters):
+    """
+    Stages of fs() and pipeline() as a DAG
+
+    preprocess -> feature_selection -> autoencoder -> encoder -> encode_dev / encode_oos / encode_oot -> model.
+    Each stage key hashes only the config that changes its outputs plus the fingerprints
+    of its deps (the input files enter through their md5), so a config change re-runs
+    just the stages downstream of it. Downstream stages are keyed on the dropped feature
+    list rather than the feature selection config, so e.g. a new feature_threshold that
+    drops the same features reuses them. The three encode stages run concurrently on the
+    one model built by the encoder stage.
+    """
+    hp = hyperparameters
+    cache_dir = hp['data_cache'] or 'cached data'
+    stages = [
+        Stage('preprocess', lambda inputs: preprocess_stage(hp),
+              config={'version': PREPROCESSING_VERSION, 'target_column': hp['target_column'],
+                      'inputs': [file_md5(path, cache_dir) for path in (hp['train_file'], hp['validation_file'], hp['test_file'])]},
+              cache=False),
+        Stage('feature_selection', lambda inputs: feature_selection_stage(hp, inputs['preprocess']), ['preprocess'],
+              config={'method': hp['feature_selection'], 'threshold': hp['feature_threshold'],
+                      'autoencoder': hp['autoencoder'], 'fpi': hp['fpi'], 'sampling': hp.get('fs_sampling'),
+                      'importance_methods': hp.get('fs_importance_methods')},
+              # Downstream stages only use the dropped list, unless they take the autoencoders as well
+              fingerprint=None if hp.get('reconstruction_features') else (
+                  lambda outputs: {'features_dropped': list(outputs['features_dropped'])})),
+        Stage('autoencoder', lambda inputs: autoencoder_stage(hp, inputs['preprocess'],
+                                                              inputs['feature_selection']['features_dropped']),
+              ['preprocess', 'feature_selection'],
+              config={'autoencoder': hp['autoencoder'], 'train_on': hp['train_on']})
+    ]
+    # Not cached: rebuilding it from the stored autoencoders is cheap
+    stages.append(Stage('encoder', lambda inputs: encoder_stage(
+                            hp, inputs['preprocess'], inputs['feature_selection']['features_dropped'],
+                            inputs['autoencoder']['autoencoder'],
+                            reconstruction_autoencoders(hp, inputs['feature_selection'])),
+                        ['preprocess', 'feature_selection', 'autoencoder'],
+                        config={'reconstruction_features': hp.get('reconstruction_features', False)},
+                        cache=False))
+    for split in ('dev', 'oos', 'oot'):
+        stages.append(Stage(f'encode_{split}',
+                            lambda inputs, split=split: encode_stage(hp, inputs['preprocess'], inputs['encoder'],
+                                                                     split),
+                            ['preprocess', 'encoder'],
+                            config={'split': split}))
+    stages.append(Stage('model', lambda inputs: model_stage(hp, inputs['preprocess'], inputs['encode_dev']['encoded'],
+                                                            inputs['encode_oos']['encoded'],
+                                                            inputs['encode_oot']['encoded']),
+                        ['preprocess', 'encode_dev', 'encode_oos', 'encode_oot'],
+                        config={'model': hp['model'], 'model_params': hp['model_params'],
+                                'model_threshold': hp['model_threshold'], 'out_of_core': hp.get('out_of_core'),
+                                'reconstruction_features': hp.get('reconstruction_features', False)}))
+    return stages
+
+def run_pipeline_stages(hyperparameters, targets):
+    """Run the stages needed for targets against the artifact store in data_cache/stages"""
+    store = ArtifactStore(os.path.join(hyperparameters['data_cache'] or 'cached data', 'stages'))
+    return run_stages(pipeline_stages(hyperparameters), targets, store)
+
+def fs(default_hyperparameters):
+    results, report = run_pipeline_stages(default_hyperparameters, ['feature_selection'])
+    selected = results['feature_selection']
+    features_to_drop = selected['features_dropped']
+
+    os.makedirs('feature selection', exist_ok=True)
+    os.makedirs('figures', exist_ok=True)
+    if report['feature_selection']['status'] == 'cached':
+        # feature_selection() only writes its importance files when it runs
+        method = default_hyperparameters['feature_selection']
+        for importance, kind in [(selected['importance_scores_abnormal'], 'abnormal'),
+                                 (selected['importance_scores_normal'], 'normal')]:
+            save_feature_importance(importance, selected['feature_names'], method, kind)
+            plot_feature_importance(importance, selected['feature_names'], method, kind)
+
+    with open('feature selection/features_dropped.txt', 'w') as f:
+        f.write(str(features_to_drop))
+
+    histories = {}
+    for name in ('history_F', 'history_NF'):
+        histories[name] = History()
+        histories[name].history = selected[name]
+    
+    return {
+        'features_dropped': features_to_drop,
+        'importance_scores_normal': selected['importance_scores_normal'],
+        'importance_scores_abnormal': selected['importance_scores_abnormal'],
+        'history_F': histories['history_F'],
+        'history_NF': histories['history_NF'],
+        'autoencoder_F': selected['autoencoder_F'],
+        'autoencoder_NF': selected['autoencoder_NF'],
+        'timings': selected['timings'],
+        'feature_names': selected['feature_names'],
+        'stages': report
+    }
+
+def pipeline(hyperparameters):
+    results, report = run_pipeline_stages(hyperparameters, ['preprocess', 'feature_selection', 'autoencoder',
+                                                            'encode_dev', 'encode_oos', 'encode_oot', 'model'])
+    data = results['preprocess']
+    features_to_drop = results['feature_selection']['features_dropped']
+    final_autoencoder = results['autoencoder']['autoencoder']
+    final_encoder_trained = Sequential(final_autoencoder.layers[:4])  # Extract encoder part
+    encoded_dev, encoded_oos, encoded_oot = [results[f'encode_{split}']['encoded'] for split in ('dev', 'oos', 'oot')]
+    scores = results['model']
 
     os.makedirs('encoded data', exist_ok=True)
     os.makedirs('saved best models', exist_ok=True)
     os.makedirs('predictions', exist_ok=True)
-    
-    if os.path.exists('feature selection/features_dropped.txt'):
-        with open('feature selection/features_dropped.txt', 'r') as f:
-            features_to_drop = [i.strip()[1:-1] for i in f.read()[1:-1].split(',')]
-        print("-------------------------------------------------")
-        print("Features to drop loaded from file.")
-    else:
-        print("-------------------------------------------------")
-        print("No features to drop. Dropping 0 features")
-        features_to_drop = []
 
-    # Drop features and continue with pipeline
+    # Saving encoded data with its target, once, as memory-mappable .npz files
+    with instrument('artifact_write'):
+        for split, encoded in [('dev', encoded_dev), ('oos', encoded_oos), ('oot', encoded_oot)]:
+            save_encoded(f'encoded data/encoded_{split}.npz', encoded, data[f'y_{split}'],
+                         compress=hyperparameters.get('encoded_compress', False))
+
     print("-------------------------------------------------")
-    print("Dropping features...")
-    new_dev_scaled = drop_features(dev_scaled, features_to_drop, feature_names)
-    new_oos_scaled = drop_features(oos_scaled, features_to_drop, feature_names)
-    new_oot_scaled = drop_features(oot_scaled, features_to_drop, feature_names)
-    print("Features dropped successfully.")
+    print("Results:")
+    print(f'1. f1_score = {scores["f1"]}')
+    print(f'2. precision = {scores["precision"]}')
+    print(f'3. recall = {scores["recall"]}')
+    print(f'4. confusion_matrix = {scores["confusion_matrix"]}')
+    print(f'5. pr_auc = {scores["pr_auc"]}')
+    print(f'6. best_f1 = {scores["best_f1"]} at threshold {scores["best_threshold"]}')
+    if scores.get('parity'):
+        print(f'7. lbfgs parity = {scores["parity"]}')
+    # Written here rather than only by train_model, so a cached model stage still refreshes them
+    scores['predictions_df'].to_csv('predictions/predictions.csv', index=False)
+    # Save confusion matrix as a seaborn heatmap image
+    sns.heatmap(np.asarray(scores['confusion_matrix']), annot=True, fmt='d', cmap='Blues')
+    plt.title('Confusion Matrix')
+    plt.xlabel('Predicted')
+    plt.ylabel('True')
+    plt.savefig('predictions/confusion_matrix.png')
+
+    with instrument('artifact_write'):
+        save_results(final_autoencoder, final_encoder_trained, scores['reg_model'],
+                     data['scaler'], features_to_drop, scores['threshold'],
+                     reconstruction_autoencoders(hyperparameters, results['feature_selection']))
     
-    # Continue with existing pipeline code...
+    return {
+        'encoded_dev': pd.DataFrame(encoded_dev, copy=False),
+        'encoded_oos': pd.DataFrame(encoded_oos, copy=False),
+        'encoded_oot': pd.DataFrame(encoded_oot, copy=False),
+        'final_autoencoder': final_autoencoder,
+        'final_encoder_trained': final_encoder_trained,
+        'reg_model': scores['reg_model'],
+        'f1': scores['f1'],
+        'precision': scores['precision'],
+        'recall': scores['recall'],
+        'confusion_matrix': scores['confusion_matrix'],
+        'threshold': scores['threshold'],
+        'pr_auc': scores['pr_auc'],
+        'best_f1': scores['best_f1'],
+        'best_threshold': scores['best_threshold'],
+        'parity': scores.get('parity'),
+        'predictions_df': scores['predictions_df'],
+        'stages': report
+    }
+
+def scale_with_saved(scaler, data, feature_names, keep, target_column):
+    """Scale a raw DataFrame with the saved scaler and keep the selected columns, returns (features, target)"""
+    scaled = scaler.transform(data[feature_names].astype(np.float32))
+    return select_columns(scaled, keep), data[target_column].to_numpy(dtype=np.int64)
+
+def retrain_key(hyperparameters, models_dir):
+    """md5 of the saved models, the new rows and the training settings, naming the retrain checkpoint"""
+    settings = hyperparameters['retrain']
+    cache_dir = hyperparameters['data_cache'] or 'cached data'
+    key = {
+        'autoencoder_model': file_md5(os.path.join(models_dir, 'autoencoder_model.h5'), cache_dir),
+        'logistic_model': file_md5(os.path.join(models_dir, 'logistic_model.pkl'), cache_dir),
+        'new_data': file_md5(settings['new_data'], cache_dir),
+        'start_row': settings.get('start_row', 0),
+        'epochs': settings['epochs'],
+        'batch_size': hyperparameters['autoencoder']['batch_size'],
+        'train_on': hyperparameters['train_on']
+    }
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def retrain(hyperparameters):
+    """
+    Continue training the saved autoencoder and logistic model on new rows only
+
+    retrain.new_data is a file with the input schema; rows before retrain.start_row
+    (e.g. the part of an appended dev file the models were trained on) are skipped.
+    The new rows are scaled with the saved scaler and keep the saved feature
+    selection, the autoencoder resumes from its saved weights for retrain.epochs
+    epochs and the logistic model is refitted with warm_start from its coefficients.
+    lbfgs refits to convergence on its training rows, so these are the new rows plus a
+    uniform sample of retrain.history_rows dev and oos rows (oos only with the
+    reconstruction error features), encoded with the retrained encoder; without
+    history_rows the refitted model only reflects the new rows. An out-of-core
+    SGDClassifier instead continues with partial_fit on the new rows.
+    Every epoch is checkpointed under data_cache/retrain, so an interrupted run picks
+    up at its last finished epoch. When the saved models include the reconstruction
+    error features, the saved feature selection autoencoders are reused unchanged.
+    Scores on the oot file like pipeline() and replaces the saved models.
+    """
+    settings = hyperparameters['retrain']
+    models_dir = settings.get('models_dir', 'saved best models')
+    target_column = hyperparameters['target_column']
+    cache_dir = hyperparameters['data_cache']
+
+    scaler = joblib.load(os.path.join(models_dir, 'scaler.pkl'))
+    reg_model = joblib.load(os.path.join(models_dir, 'logistic_model.pkl'))
+    with open(os.path.join(models_dir, 'features_dropped.json'), 'r') as f:
+        features_to_drop = json.load(f)
+    feature_names = list(scaler.feature_names_in_)
+    keep = feature_indices(features_to_drop, feature_names)
+    reconstruction_models = None
+    if os.path.exists(os.path.join(models_dir, 'feature_model.keras')):
+        reconstruction_models = [keras.models.load_model(os.path.join(models_dir, f'autoencoder_{label}.keras'))
+                                 for label in ('F', 'NF')]
+    # The feature model takes every scaled column, the encoder only the kept ones
+    columns = np.arange(len(feature_names)) if reconstruction_models else keep
+
+    new_data = load_csv(settings['new_data'], cache_dir).iloc[settings.get('start_row', 0):]
+    if len(new_data) == 0:
+        raise ValueError(f"No new rows in {settings['new_data']} after row {settings.get('start_row', 0)}.")
+    X_new, y_new = scale_with_saved(scaler, new_data, feature_names, columns, target_column)
+    X_oos, y_oos = scale_with_saved(scaler, load_csv(hyperparameters['validation_file'], cache_dir),
+                                    feature_names, columns, target_column)
+    X_oot, y_oot = scale_with_saved(scaler, load_csv(hyperparameters['test_file'], cache_dir),
+                                    feature_names, columns, target_column)
     if hyperparameters['train_on'] == 'normal':
-        train_on = drop_features(scaled_dev_NF, features_to_drop, feature_names)
-        val_on = drop_features(scaled_oos_NF, features_to_drop, feature_names)
+        train_on, val_on = X_new[y_new == 0], X_oos[y_oos == 0]
     elif hyperparameters['train_on'] == 'abnormal':
-        train_on = drop_features(scaled_dev_F, features_to_drop, feature_names)
-        val_on = drop_features(scaled_dev_F, features_to_drop, feature_names)
-    
+        train_on = val_on = X_new[y_new == 1]
+    if reconstruction_models:
+        train_on, val_on = select_columns(train_on, keep), select_columns(val_on, keep)
     print("-------------------------------------------------")
-    print("Training main autoencoder with dropped features..")
-    final_autoencoder = build_autoencoder(train_on.shape[1], 
-                                                hyperparameters['autoencoder']['ratios'],
-                                                hyperparameters['autoencoder']['hidden_activation'], 
-                                                hyperparameters['autoencoder']['dropout'],
-                                                hyperparameters['autoencoder']['optimizer'], 
-                                                hyperparameters['autoencoder']['loss'])
-    
-    history_final = final_autoencoder.fit(
-        train_on, train_on,
-        epochs=hyperparameters['autoencoder']['epochs'],
-        batch_size=hyperparameters['autoencoder']['batch_size'],
-        validation_data=(val_on, val_on)
-    )
-    final_encoder_trained = Sequential(final_autoencoder.layers[:4])  # Extract encoder part
+    print(f"Retraining on {len(new_data)} new rows from {settings['new_data']}")
 
-    print("Main autoencoder trained successfully.")
+    checkpoint_dir = os.path.join(cache_dir or 'cached data', 'retrain', retrain_key(hyperparameters, models_dir))
+    autoencoder, initial_epoch = load_checkpoint(checkpoint_dir)
+    if autoencoder is None:
+        autoencoder = load_autoencoder_from_config(os.path.join(models_dir, 'autoencoder_model.h5'),
+                                                   hyperparameters['autoencoder'])
+    else:
+        print(f"Resuming from the checkpoint after epoch {initial_epoch}")
+    if initial_epoch < settings['epochs']:
+        fit_autoencoder(autoencoder, train_on, val_on, settings['epochs'], hyperparameters['autoencoder']['batch_size'],
+                        callbacks=[EpochCheckpoint(checkpoint_dir)], initial_epoch=initial_epoch)
+    encoder = Sequential(autoencoder.layers[:4])  # Extract encoder part
+    print("Autoencoder retrained successfully.")
+    features_model = encoder
+    if reconstruction_models:
+        features_model = build_feature_model(autoencoder, reconstruction_models, keep, len(feature_names))
+
+    encoded_new = encode_data(features_model, X_new, hyperparameters['encode_chunk_size'])
+    encoded_oot = encode_data(features_model, X_oot, hyperparameters['encode_chunk_size'])
+    out_of_core = hyperparameters.get('out_of_core') or {}
+    if out_of_core.get('enabled') and isinstance(reg_model, SGDClassifier):
+        # More partial_fit passes from the saved coefficients and class weights
+        reg_model, f1, precision, recall, confusion_mat, predictions_df, threshold, curve_metrics = \
+            train_model_out_of_core([(encoded_new, y_new)], encoded_oot, y_oot, hyperparameters['model_params'],
+                                    hyperparameters['model_threshold'], out_of_core, reg_model)
+    else:
+        # lbfgs runs to convergence on whatever it is given, warm_start only sets its starting
+        # point, so the new rows are joined by a sample of the rows the model was trained on
+        X_fit, y_fit = encoded_new, y_new
+        if settings.get('history_rows'):
+            history = [(X_oos, y_oos)]
+            if not reconstruction_models:
+                # As in model_stage: with the reconstruction error features only oos was used
+                history.insert(0, scale_with_saved(scaler, load_csv(hyperparameters['train_file'], cache_dir),
+                                                   feature_names, columns, target_column))
+            X_history, y_history = sample_rows(history, settings['history_rows'], settings.get('seed', 42))
+            X_fit = np.concatenate([encoded_new, encode_data(features_model, X_history,
+                                                             hyperparameters['encode_chunk_size'])])
+            y_fit = np.concatenate([y_new, y_history])
+            print(f"Refitting the logistic model on the new rows and {len(y_history)} sampled history rows.")
+        reg_model, f1, precision, recall, confusion_mat, predictions_df, threshold, curve_metrics = train_model(
+            X_fit, y_fit, encoded_oot, y_oot,
+            hyperparameters['model'], hyperparameters['model_params'], hyperparameters['model_threshold'], reg_model)
+    print("Regression model retrained successfully.")
 
-    print("-------------------------------------------------")
-    print("Encoding data with trained autoencoder...")
-    encoded_dev = pd.DataFrame(encode_data(final_encoder_trained, new_dev_scaled))
-    encoded_oos = pd.DataFrame(encode_data(final_encoder_trained, new_oos_scaled))
-    encoded_oot = pd.DataFrame(encode_data(final_encoder_trained, new_oot_scaled))
-
-    # Saving encoded data
-    encoded_dev.to_csv('encoded data/encoded_dev.csv', index=False)
-    encoded_oos.to_csv('encoded data/encoded_oos.csv', index=False)
-    encoded_oot.to_csv('encoded data/encoded_oot.csv', index=False)
-    print("Data encoded successfully.")
-
-    encoded_dev2 = pd.concat([encoded_dev, dev[hyperparameters['target_column']]], axis=1)
-    encoded_oos2 = pd.concat([encoded_oos, oos[hyperparameters['target_column']]], axis=1)
-    encoded_train = pd.concat([encoded_dev2, encoded_oos2], axis=0)
-    print("-------------------------------------------------")
-    print("Training regression model...")
-    reg_model, f1, precision, recall, confusion_mat, predictions_df = train_model(encoded_train.drop(columns=encoded_train.columns[-1]),
-                                                        encoded_train[encoded_train.columns[-1]], 
-                                                        encoded_oot, 
-                                                        oot[hyperparameters['target_column']],
-                                                        hyperparameters["model"], 
-                                                        hyperparameters["model_params"],
-                                                        hyperparameters["model_threshold"])
-    print("Regression model trained successfully.")
     print("-------------------------------------------------")
     print("Results:")
     print(f'1. f1_score = {f1}')
     print(f'2. precision = {precision}')
     print(f'3. recall = {recall}')
     print(f'4. confusion_matrix = {confusion_mat}')
-    # Save confusion matrix as a seaborn heatmap image
-    sns.heatmap(confusion_mat, annot=True, fmt='d', cmap='Blues')
+    print(f'5. pr_auc = {curve_metrics["pr_auc"]}')
+    print(f'6. best_f1 = {curve_metrics["best_f1"]} at threshold {curve_metrics["best_threshold"]}')
+    os.makedirs('predictions', exist_ok=True)
+    sns.heatmap(np.asarray(confusion_mat), annot=True, fmt='d', cmap='Blues')
     plt.title('Confusion Matrix')
     plt.xlabel('Predicted')
     plt.ylabel('True')
     plt.savefig('predictions/confusion_matrix.png')
 
-    save_results(encoded_dev, encoded_oos, encoded_oot, 
-                final_autoencoder, final_encoder_trained, reg_model)
-    
+    with instrument('artifact_write'):
+        save_results(autoencoder, encoder, reg_model, scaler, features_to_drop, threshold, reconstruction_models)
+    # The saved models now include the new rows; their checkpoint is no longer needed
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
     return {
-        'encoded_dev': encoded_dev,
-        'encoded_oos': encoded_oos,
-        'encoded_oot': encoded_oot,
-        'final_autoencoder': final_autoencoder,
-        'final_encoder_trained': final_encoder_trained,
+        'final_autoencoder': autoencoder,
+        'final_encoder_trained': encoder,
         'reg_model': reg_model,
         'f1': f1,
         'precision': precision,
         'recall': recall,
         'confusion_matrix': confusion_mat,
-        'predictions_df': predictions_df
-    }
\ No newline at end of file
+        'threshold': threshold,
+        'pr_auc': curve_metrics['pr_auc'],
+        'best_f1': curve_metrics['best_f1'],
+        'best_threshold': curve_metrics['best_threshold'],
+        'predictions_df': predictions_df,
+        'new_rows': len(new_data)
+    }
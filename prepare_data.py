@@ -1,20 +1,232 @@
+import os
+import json
+import time
+import hashlib
+import shutil
+import joblib
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
-from keras.models import Sequential
+from instrumentation import instrument, peak_rss_mb
+from encoded_storage import EncodedWriter
 
-def load_data(dev_path, oos_path, oot_path):
-    dev = pd.read_csv(dev_path)
-    oos = pd.read_csv(oos_path)
-    oot = pd.read_csv(oot_path)
+# Bump whenever the layout or contents of the preprocessing artifact change
+PREPROCESSING_VERSION = 1
+
+def load_data(dev_path, oos_path, oot_path, cache_dir=None):
+    dev = load_csv(dev_path, cache_dir)
+    oos = load_csv(oos_path, cache_dir)
+    oot = load_csv(oot_path, cache_dir)
     return dev, oos, oot
 
-def standardize_data(dev, oos, oot):
+def load_csv(path, cache_dir=None):
+    """
+    Load one input CSV, going through the binary cache when cache_dir is set
+
+    On the first load the CSV is parsed and written to cache_dir as a float32 .npy
+    file named after the md5 of the CSV. Later loads memory-map that file instead of
+    parsing the CSV again. Load time and peak RSS are printed either way.
+    Cached loads return every column as float32, including integer columns such as
+    the target (0.0/1.0), so the frame stays a view of the memory map; float64 inputs
+    are narrowed to float32 and differ slightly from a data_cache: null load.
+    """
+    start = time.perf_counter()
+    with instrument('load') as measurement:
+        if cache_dir is None:
+            data, source = pd.read_csv(path), 'csv'
+        else:
+            md5 = file_md5(path, cache_dir)
+            dvc_md5 = dvc_file_md5(path)
+            if dvc_md5 is not None and dvc_md5 != md5:
+                print(f"Warning: {path} differs from the DVC tracked version ({dvc_md5}).")
+            data, source = read_cached_csv(path, md5, cache_dir)
+        measurement['rows'] = len(data)
+    print(f"Loaded {path} from {source} in {time.perf_counter() - start:.2f}s (peak RSS {peak_rss_mb():.0f} MB)")
+    return data
+
+def read_cached_csv(path, md5, cache_dir):
+    """Memory-map the cached copy of a CSV, building it first on a cache miss"""
+    array_path = os.path.join(cache_dir, f'{md5}.npy')
+    meta_path = os.path.join(cache_dir, f'{md5}.json')
+    source = 'cache'
+    if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+        data = pd.read_csv(path)
+        if not data.select_dtypes(exclude='number').empty:
+            # Non-numeric columns cannot go into a float32 matrix, keep the CSV path
+            return data, 'csv'
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = array_path + '.tmp.npy'
+        np.save(tmp_path, data.to_numpy(dtype=np.float32))
+        os.replace(tmp_path, array_path)
+        with open(meta_path, 'w') as f:
+            json.dump({
+                'source': path,
+                'md5': md5,
+                'columns': list(data.columns),
+                'int_columns': {c: str(t) for c, t in data.dtypes.items() if t.kind in 'iub'}
+            }, f)
+        # Serve the freshly built file so cold and warm loads return identical data
+        del data
+        source = 'csv (cache built)'
+
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    values = np.load(array_path, mmap_mode='r')
+    # No astype back to the integer columns: it would copy the whole file into memory
+    return pd.DataFrame(values, columns=meta['columns'], copy=False), source
+
+def file_md5(path, cache_dir):
+    """
+    md5 of a file's contents, the same hash DVC records for it
+
+    Hashes are remembered in cache_dir/index.json by path, size and mtime, so an
+    unchanged file is only hashed once.
+    """
+    index_path = os.path.join(cache_dir, 'index.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    entry = index.get(key)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['md5']
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    index[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': md5.hexdigest()}
+    os.makedirs(cache_dir, exist_ok=True)
+    # Replaced in one step, so concurrent readers never see a truncated index
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, index_path)
+    return md5.hexdigest()
+
+def dvc_file_md5(path):
+    """
+    md5 recorded by DVC for a file inside a tracked directory, None when unavailable
+
+    Reads '<dir>.dvc' for the directory hash and looks the file up in the matching
+    '.dir' listing of the local DVC cache.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    dvc_path = directory + '.dvc'
+    if not os.path.exists(dvc_path):
+        return None
+    with open(dvc_path, 'r') as f:
+        dir_md5 = next((line.split('md5:')[1].strip() for line in f if 'md5:' in line), None)
+    if dir_md5 is None or not dir_md5.endswith('.dir'):
+        return None
+    repo = os.path.dirname(directory)
+    for listing_path in [os.path.join(repo, '.dvc', 'cache', 'files', 'md5', dir_md5[:2], dir_md5[2:]),
+                         os.path.join(repo, '.dvc', 'cache', dir_md5[:2], dir_md5[2:])]:
+        if os.path.exists(listing_path):
+            with open(listing_path, 'r') as f:
+                listing = json.load(f)
+            return next((entry['md5'] for entry in listing if entry['relpath'] == name), None)
+    return None
+
+def standardize_data(dev, oos, oot, target_column='Class'):
+    # sklearn is imported here, so profiling and scoring never pay for it
+    from sklearn.preprocessing import StandardScaler
+
     scaler = StandardScaler()
-    dev_scaled = scaler.fit_transform(dev.drop(['Class'], axis=1))
-    oos_scaled = scaler.transform(oos.drop(['Class'], axis=1))
-    oot_scaled = scaler.transform(oot.drop(['Class'], axis=1))
+    dev_scaled = scaler.fit_transform(dev.drop([target_column], axis=1))
+    oos_scaled = scaler.transform(oos.drop([target_column], axis=1))
+    oot_scaled = scaler.transform(oot.drop([target_column], axis=1))
     return dev_scaled, oos_scaled, oot_scaled, scaler
 
+def preprocess_data(dev_path, oos_path, oot_path, target_column='Class', cache_dir=None):
+    """
+    Load, scale and split the input data once, reusing a saved artifact when possible
+
+    The artifact holds the fitted scaler, the scaled float32 dev/oos/oot matrices,
+    the targets and the fraud/non-fraud row indices of dev and oos. It is stored in
+    cache_dir/preprocessed/<key>, where the key hashes the input file md5s, the
+    target column and PREPROCESSING_VERSION, so fs() and pipeline() share it as long
+    as the inputs and config match. Fraud and non-fraud subsets are taken from the
+    scaled matrices with these indices instead of being transformed again. The key is
+    returned as data['key'] (None without a cache_dir) so later stages can key their
+    own caches on it.
+    """
+    if cache_dir is not None:
+        key = hashlib.md5(json.dumps({
+            'version': PREPROCESSING_VERSION,
+            'inputs': [file_md5(path, cache_dir) for path in (dev_path, oos_path, oot_path)],
+            'target_column': target_column
+        }, sort_keys=True).encode()).hexdigest()
+        artifact_dir = os.path.join(cache_dir, 'preprocessed', key)
+        if os.path.exists(os.path.join(artifact_dir, 'meta.json')):
+            print(f"Preprocessed data loaded from {artifact_dir}.")
+            return load_preprocessed(artifact_dir)
+
+    dev, oos, oot = load_data(dev_path, oos_path, oot_path, cache_dir)
+    feature_names = list(dev.drop([target_column], axis=1).columns)
+    with instrument('scale', len(dev) + len(oos) + len(oot)):
+        dev_scaled, oos_scaled, oot_scaled, scaler = standardize_data(
+            dev.astype({c: np.float32 for c in feature_names}, copy=False),
+            oos.astype({c: np.float32 for c in feature_names}, copy=False),
+            oot.astype({c: np.float32 for c in feature_names}, copy=False),
+            target_column)
+    with instrument('split', len(dev) + len(oos)):
+        # Cached loads keep the target as float32
+        y_dev = dev[target_column].to_numpy(dtype=np.int64)
+        y_oos = oos[target_column].to_numpy(dtype=np.int64)
+        split_indices = {
+            'dev_F_idx': np.flatnonzero(y_dev == 1),
+            'dev_NF_idx': np.flatnonzero(y_dev == 0),
+            'oos_F_idx': np.flatnonzero(y_oos == 1),
+            'oos_NF_idx': np.flatnonzero(y_oos == 0)
+        }
+    data = {
+        'scaler': scaler,
+        'feature_names': feature_names,
+        'dev_scaled': dev_scaled,
+        'oos_scaled': oos_scaled,
+        'oot_scaled': oot_scaled,
+        'y_dev': y_dev,
+        'y_oos': y_oos,
+        'y_oot': oot[target_column].to_numpy(dtype=np.int64),
+        **split_indices,
+        'key': key if cache_dir is not None else None
+    }
+    if cache_dir is not None:
+        save_preprocessed(data, artifact_dir, {'key': key, 'target_column': target_column,
+                                               'inputs': [dev_path, oos_path, oot_path]})
+        print(f"Preprocessed data saved to {artifact_dir}.")
+    return data
+
+def save_preprocessed(data, artifact_dir, meta):
+    """Write a preprocessing artifact, replacing the directory atomically"""
+    tmp_dir = artifact_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, value in data.items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), value)
+    joblib.dump(data['scaler'], os.path.join(tmp_dir, 'scaler.pkl'))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(meta, version=PREPROCESSING_VERSION, feature_names=data['feature_names']), f, indent=4)
+    shutil.rmtree(artifact_dir, ignore_errors=True)
+    os.replace(tmp_dir, artifact_dir)
+
+def load_preprocessed(artifact_dir):
+    """Read a preprocessing artifact, memory-mapping its arrays"""
+    with open(os.path.join(artifact_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta['version'] != PREPROCESSING_VERSION:
+        raise ValueError(f"Preprocessing artifact version {meta['version']} is not supported.")
+    data = {'scaler': joblib.load(os.path.join(artifact_dir, 'scaler.pkl')),
+            'feature_names': meta['feature_names'],
+            'key': meta['key']}
+    for file_name in sorted(os.listdir(artifact_dir)):
+        if file_name.endswith('.npy'):
+            data[file_name[:-4]] = np.load(os.path.join(artifact_dir, file_name), mmap_mode='r')
+    return data
+
 def split_data(dev, oos):
     dev_F = dev[dev['Class'] == 1].drop(columns=['Class'])
     dev_NF = dev[dev['Class'] == 0].drop(columns=['Class'])
@@ -22,6 +234,68 @@ def split_data(dev, oos):
     oos_NF = oos[oos['Class'] == 0].drop(columns=['Class'])
     return dev_F, dev_NF, oos_F, oos_NF
 
-def encode_data(encoder, data):
-    encoded_data = encoder.predict(data)
-    return encoded_data
\ No newline at end of file
+def encode_data(encoder, data, chunk_size=None, keep=None):
+    """
+    Encode data with the trained encoder, keeping only the columns in keep
+    
+    With chunk_size set the rows are encoded chunk by chunk into a preallocated
+    output, so only one chunk of a (memory-mapped) input is resident at a time.
+    """
+    with instrument('encode', len(data)):
+        if chunk_size is None or len(data) == 0:
+            return encoder.predict(data if keep is None else np.asarray(data)[:, keep])
+        encoded_data = None
+        for start in range(0, len(data), chunk_size):
+            chunk = np.asarray(data[start:start + chunk_size], dtype=np.float32)
+            if keep is not None:
+                chunk = chunk[:, keep]
+            encoded = encoder.predict(chunk, batch_size=min(chunk_size, 8192), verbose=0)
+            if encoded_data is None:
+                encoded_data = np.empty((len(data), encoded.shape[1]), dtype=encoded.dtype)
+            encoded_data[start:start + len(encoded)] = encoded
+        return encoded_data
+
+def read_csv_chunks(path, chunk_size, cache_dir=None):
+    """
+    Yield an input CSV as DataFrames of chunk_size rows
+    
+    Uses the memory-mapped binary cache when one exists for the file, otherwise
+    reads the CSV incrementally.
+    """
+    if cache_dir is not None:
+        md5 = file_md5(path, cache_dir)
+        array_path = os.path.join(cache_dir, f'{md5}.npy')
+        meta_path = os.path.join(cache_dir, f'{md5}.json')
+        if os.path.exists(array_path) and os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            values = np.load(array_path, mmap_mode='r')
+            for start in range(0, len(values), chunk_size):
+                # float32 columns throughout, as in read_cached_csv
+                yield pd.DataFrame(np.array(values[start:start + chunk_size]), columns=meta['columns'], copy=False)
+            return
+    yield from pd.read_csv(path, chunksize=chunk_size)
+
+def encode_file(encoder, scaler, input_path, output_path, features_to_drop=(), target_column='Class',
+                chunk_size=100000, cache_dir=None, compress=False):
+    """
+    Stream an input file through the saved scaler, feature drop list and encoder
+    
+    Rows are read, scaled, reduced to the kept features and encoded chunk by chunk,
+    and written to output_path as an encoded_storage .npz file (float32 features, the
+    int8 target when the input has one, and the row index). Peak memory is bounded by
+    chunk_size, not by the file size. Returns the number of rows written.
+    """
+    feature_names = None
+    keep = None
+    writer = EncodedWriter(output_path, compress)
+    for chunk in read_csv_chunks(input_path, chunk_size, cache_dir):
+        if feature_names is None:
+            feature_names = list(getattr(scaler, 'feature_names_in_', [c for c in chunk.columns if c != target_column]))
+            dropped = set(features_to_drop)
+            keep = np.array([i for i, name in enumerate(feature_names) if name not in dropped], dtype=np.intp)
+        scaled = scaler.transform(chunk[feature_names].astype(np.float32))
+        encoded = encoder.predict(np.asarray(scaled)[:, keep], batch_size=min(chunk_size, 8192), verbose=0)
+        writer.append(encoded, chunk[target_column].to_numpy() if target_column in chunk.columns else None)
+    writer.close()
+    return writer.rows
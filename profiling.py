@@ -0,0 +1,204 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import joblib
+import numpy as np
+import pandas as pd
+from prepare_data import read_csv_chunks, file_md5
+
+# Bump whenever ColumnSketch changes, so cached profiles are rebuilt
+PROFILE_VERSION = 1
+
+class ColumnSketch:
+    """
+    Mergeable one-pass summary of every column of a numeric table
+
+    count/mean/std come from Welford moments (merged with Chan's formula), min/max
+    are exact and quantiles come from a KLL-style compactor sketch: level h holds
+    items of weight 2**h and, once a level exceeds k items, it is sorted and every
+    other item (random offset) is promoted to the next level. Memory stays around
+    k * log2(n / k) values per column and two sketches of disjoint data merge into
+    the sketch of their union.
+    """
+
+    def __init__(self, columns, k=2048, seed=0):
+        self.columns = list(columns)
+        self.k = k
+        self.count = 0
+        self.mean = np.zeros(len(self.columns))
+        self.m2 = np.zeros(len(self.columns))
+        self.min = np.full(len(self.columns), np.inf)
+        self.max = np.full(len(self.columns), -np.inf)
+        self.levels = []
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        """Add a (rows, columns) block of values"""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        mean = values.mean(axis=0)
+        self._merge_moments(len(values), mean, ((values - mean) ** 2).sum(axis=0))
+        self.min = np.minimum(self.min, values.min(axis=0))
+        self.max = np.maximum(self.max, values.max(axis=0))
+        self._add_items([values])
+
+    def merge(self, other):
+        """Fold another sketch of the same columns into this one"""
+        if other.columns != self.columns:
+            raise ValueError("Only sketches of the same columns can be merged.")
+        if other.count == 0:
+            return self
+        self._merge_moments(other.count, other.mean, other.m2)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self._add_items(other.levels)
+        return self
+
+    def _merge_moments(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def _add_items(self, levels):
+        empty = np.empty((0, len(self.columns)))
+        for h, items in enumerate(levels):
+            if h == len(self.levels):
+                self.levels.append(empty)
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        h = 0
+        while h < len(self.levels):
+            items = self.levels[h]
+            if len(items) > self.k:
+                items = np.sort(items, axis=0)
+                # An odd item out stays at this level so the total weight is kept exactly
+                self.levels[h], items = items[len(items) - len(items) % 2:], items[:len(items) - len(items) % 2]
+                if h + 1 == len(self.levels):
+                    self.levels.append(empty)
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], items[self.rng.integers(2)::2]])
+            h += 1
+
+    def _weighted_items(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** h) for h, level in enumerate(self.levels)])
+        return items, weights
+
+    def quantiles(self, qs):
+        """Approximate quantiles, shape (len(qs), columns)"""
+        items, weights = self._weighted_items()
+        result = np.empty((len(qs), len(self.columns)))
+        for j in range(len(self.columns)):
+            order = np.argsort(items[:, j])
+            cumulative = np.cumsum(weights[order])
+            ranks = (cumulative - weights[order] / 2) / cumulative[-1]
+            result[:, j] = np.interp(qs, ranks, items[order, j])
+        return result
+
+    def cdf(self, edges):
+        """Approximate fraction of values <= each edge; edges has shape (n_edges, columns)"""
+        items, weights = self._weighted_items()
+        result = np.empty(edges.shape)
+        for j in range(len(self.columns)):
+            order = np.argsort(items[:, j])
+            cumulative = np.concatenate([[0], np.cumsum(weights[order])])
+            result[:, j] = cumulative[np.searchsorted(items[order, j], edges[:, j], side='right')] / cumulative[-1]
+        return result
+
+    def describe(self):
+        """count/mean/std/min/quartiles/max per column, laid out like DataFrame.describe()"""
+        std = np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.full(len(self.columns), np.nan)
+        return pd.DataFrame(np.vstack([np.full(len(self.columns), self.count), self.mean, std, self.min,
+                                       self.quantiles([0.25, 0.5, 0.75]), self.max]),
+                            index=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'], columns=self.columns)
+
+def population_stability_index(expected, actual, bins=10, eps=1e-6):
+    """
+    PSI of every column between two sketches, over bins at the deciles (by default) of expected
+
+    Above 0.1 is usually read as a moderate and above 0.25 as a significant shift.
+    """
+    edges = expected.quantiles(np.linspace(0, 1, bins + 1)[1:-1])
+    def fractions(sketch):
+        cdf = sketch.cdf(edges)
+        return np.clip(np.diff(np.vstack([np.zeros(len(sketch.columns)), cdf, np.ones(len(sketch.columns))]), axis=0),
+                       eps, None)
+    e, a = fractions(expected), fractions(actual)
+    return pd.Series(((a - e) * np.log(a / e)).sum(axis=0), index=expected.columns)
+
+def profile_cache_path(path, cache_dir, sketch_size):
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, 'profiles', f'{file_md5(path, cache_dir)}_{sketch_size}_v{PROFILE_VERSION}.pkl')
+
+def profile_file(path, cache_dir=None, chunk_size=100000, sketch_size=2048):
+    """
+    Sketch every column of one input file in a single streaming pass
+
+    With cache_dir set the sketch is saved under cache_dir/profiles, keyed by the file
+    md5, so unchanged files are not read again. Chunks come from the binary CSV cache
+    when one exists (see read_csv_chunks). Those values are float32, so the regenerated
+    <split>_profile.csv files then differ slightly from a float64 describe() of the CSV.
+    Raises ValueError for a file without rows.
+    """
+    cache_path = profile_cache_path(path, cache_dir, sketch_size)
+    if cache_path is not None and os.path.exists(cache_path):
+        return joblib.load(cache_path)
+
+    start = time.perf_counter()
+    sketch = None
+    for chunk in read_csv_chunks(path, chunk_size, cache_dir):
+        if sketch is None:
+            sketch = ColumnSketch(chunk.columns, sketch_size)
+        sketch.update(chunk.to_numpy(dtype=np.float64))
+    if sketch is None or sketch.count == 0:
+        raise ValueError(f"{path} has no rows to profile.")
+    print(f"Profiled {path} ({sketch.count} rows) in {time.perf_counter() - start:.2f}s")
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        joblib.dump(sketch, cache_path)
+    return sketch
+
+def profile_data(paths, cache_dir=None, chunk_size=100000, sketch_size=2048):
+    """Sketch the {name: path} files in parallel, one worker process per file that is not cached yet"""
+    sketches, pending = {}, {}
+    for name, path in paths.items():
+        cache_path = profile_cache_path(path, cache_dir, sketch_size)
+        if cache_path is not None and os.path.exists(cache_path):
+            sketches[name] = joblib.load(cache_path)
+        else:
+            pending[name] = path
+    if pending:
+        with ProcessPoolExecutor(max_workers=len(pending), mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {name: executor.submit(profile_file, path, cache_dir, chunk_size, sketch_size)
+                       for name, path in pending.items()}
+            sketches.update({name: future.result() for name, future in futures.items()})
+    return {name: sketches[name] for name in paths}
+
+def drift_report(hyperparameters, output_dir='feature selection'):
+    """
+    Profile dev/oos/oot and compute the PSI of oos and oot against dev
+
+    Writes <split>_profile.csv (describe()-style stats) and drift_report.csv (PSI per
+    column, flagged above profile.psi_threshold) to output_dir and returns the
+    profiles and the drift table.
+    """
+    settings = hyperparameters['profile']
+    sketches = profile_data({'dev': hyperparameters['train_file'], 'oos': hyperparameters['validation_file'],
+                             'oot': hyperparameters['test_file']},
+                            hyperparameters['data_cache'], settings['chunk_size'], settings['sketch_size'])
+    os.makedirs(output_dir, exist_ok=True)
+    profiles = {}
+    for name, sketch in sketches.items():
+        profiles[name] = sketch.describe()
+        profiles[name].to_csv(os.path.join(output_dir, f'{name}_profile.csv'))
+
+    features = [c for c in sketches['dev'].columns if c != hyperparameters['target_column']]
+    drift = pd.DataFrame({f'psi_{name}': population_stability_index(sketches['dev'], sketches[name],
+                                                                    settings['psi_bins'])[features]
+                          for name in ('oos', 'oot')})
+    drift['drifted'] = drift.max(axis=1) > settings['psi_threshold']
+    drift.to_csv(os.path.join(output_dir, 'drift_report.csv'))
+    return profiles, drift
@@ -0,0 +1,43 @@
+import sys
+import json
+import logging
+import argparse
+import traceback
+from batch_scoring import score_file
+
+# Configure logging
+logging.basicConfig(
+    filename='fraud_pipeline.log',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a large file with the saved models in parallel shards")
+    parser.add_argument("input", help="input CSV with the same columns as the training data")
+    parser.add_argument("output_dir", help="directory for the scores_<shard>.npy files and manifest.json")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--shard-rows", type=int, default=1000000, help="rows per shard and output file")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="rows scored at a time in a worker")
+    parser.add_argument("--models-dir", default="saved best models")
+    parser.add_argument("--backend", choices=["keras", "fused"], default="fused",
+                        help="'fused' scores with the NumPy export and never imports TensorFlow")
+    args = parser.parse_args(argv)
+
+    with open('default_hyperparameters.json', 'r') as f:
+        default_hyperparameters = json.load(f)
+    try:
+        manifest = score_file(args.input, args.output_dir, args.models_dir, args.workers, args.shard_rows,
+                              args.chunk_size, args.backend, default_hyperparameters['target_column'],
+                              default_hyperparameters['data_cache'] or 'cached data')
+        logging.info(f"Batch scored {manifest['rows']} rows of {args.input} into {args.output_dir} "
+                     f"({manifest['rows_per_sec']:.0f} rows/s, {manifest['workers']} workers, sha256 {manifest['sha256']})")
+    except Exception as e:
+        logging.error(f"Error during batch scoring: {str(e)}")
+        logging.error(traceback.format_exc())
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
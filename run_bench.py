@@ -0,0 +1,37 @@
+import sys
+import json
+import logging
+import argparse
+import traceback
+from benchmark import STAGES, run_benchmarks, save_benchmark_results
+
+# Configure logging
+logging.basicConfig(
+    filename='benchmark.log',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000],
+                        help="total rows (dev + oos + oot) per run, e.g. --rows 100000 1000000 10000000")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--epochs", type=int, default=1, help="autoencoder epochs in the fs and pipeline runs")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output-dir", default="benchmark results")
+    args = parser.parse_args(argv)
+    try:
+        results = run_benchmarks(args.rows, args.stages, epochs=args.epochs, seed=args.seed)
+        path = save_benchmark_results(results, args.output_dir)
+        logging.info(f"Benchmark results: {json.dumps(results)}")
+        print(f"Benchmark results saved to {path}")
+    except Exception as e:
+        logging.error(f"Error during benchmark: {str(e)}")
+        logging.error(traceback.format_exc())
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
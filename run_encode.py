@@ -0,0 +1,56 @@
+import sys
+import json
+import logging
+import argparse
+import traceback
+import joblib
+from prepare_data import encode_file
+
+# Configure logging
+logging.basicConfig(
+    filename='fraud_pipeline.log',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+def run_encode(input_path, output_path, chunk_size=None):
+    """Encode a (large) input file chunk by chunk with the saved best models"""
+    from scoring import load_keras_encoder
+
+    with open('default_hyperparameters.json', 'r') as f:
+        default_hyperparameters = json.load(f)
+
+    scaler = joblib.load('saved best models/scaler.pkl')
+    with open('saved best models/features_dropped.json', 'r') as f:
+        features_to_drop = json.load(f)
+    encoder, keep = load_keras_encoder('saved best models', None)
+    if keep is not None:
+        # The feature model takes every scaled column
+        features_to_drop = []
+
+    rows = encode_file(encoder, scaler, input_path, output_path, features_to_drop,
+                       default_hyperparameters['target_column'],
+                       chunk_size or default_hyperparameters['encode_chunk_size'],
+                       default_hyperparameters['data_cache'],
+                       default_hyperparameters.get('encoded_compress', False))
+    logging.info(f"Encoded {rows} rows of {input_path} into {output_path}")
+    print(f"Encoded {rows} rows of {input_path} into {output_path}")
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a CSV through the saved scaler and encoder")
+    parser.add_argument("input", help="input CSV with the same columns as the training data")
+    parser.add_argument("output", help=".npz file the encoded rows are written to (see encoded_storage)")
+    parser.add_argument("--chunk-size", type=int, default=None, help="rows per chunk (default: encode_chunk_size)")
+    args = parser.parse_args(argv)
+    try:
+        run_encode(args.input, args.output, args.chunk_size)
+    except Exception as e:
+        logging.error(f"Error during encoding: {str(e)}")
+        logging.error(traceback.format_exc())
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,11 +2,9 @@ import json
 import logging
 import mlflow
 import traceback
-from pipeline import *
-from feature_selection import *
-from prepare_data import *
-from autoencoder import *
-from mlflow_utils import *
+from pipeline import pipeline, retrain
+from instrumentation import stage_records
+from mlflow_utils import init_mlflow, AsyncLogger
 
 # Configure logging
 logging.basicConfig(
@@ -27,48 +25,69 @@ def run_pipeline():
         # Initialize MLflow
         init_mlflow("Fraud_Pipeline")
         
-        with mlflow.start_run() as run:
+        with mlflow.start_run() as run, AsyncLogger(run.info.run_id) as tracker:
             try:
                 logging.info("Running the final pipeline with default parameters and dropped features")
                 
                 # Log parameters
-                mlflow.log_params({
+                tracker.log_params({
                     "feature_selection_method": default_hyperparameters['feature_selection'],
                     "autoencoder_params": default_hyperparameters['autoencoder'],
                     "model_name": default_hyperparameters['model'],
                     "model_params": default_hyperparameters['model_params'],
+                    "out_of_core": default_hyperparameters['out_of_core'],
                 })
                 
-                # Run feature selection
-                results = pipeline(default_hyperparameters)
+                # Continue from the saved models on new rows only when retrain.new_data is set
+                retrain_mode = bool(default_hyperparameters['retrain']['new_data'])
+                tracker.log_param("mode", "retrain" if retrain_mode else "full")
+                if retrain_mode:
+                    tracker.log_param("retrain_params", default_hyperparameters['retrain'])
+                    results = retrain(default_hyperparameters)
+                else:
+                    results = pipeline(default_hyperparameters)
+                tracker.log_stage_records(stage_records())
 
-                mlflow.keras.log_model(results["final_autoencoder"], "models/autoencoder")
-                mlflow.keras.log_model(results["final_encoder_trained"], "models/encoder")
-                mlflow.sklearn.log_model(results["reg_model"], "models/reg_model")
+                tracker.log_model(mlflow.keras.save_model, results["final_autoencoder"], "models/autoencoder")
+                tracker.log_model(mlflow.keras.save_model, results["final_encoder_trained"], "models/encoder")
+                tracker.log_model(mlflow.sklearn.save_model, results["reg_model"], "models/reg_model")
 
-                mlflow.log_metrics({
+                tracker.log_metrics({
                     "f1_score": results['f1'],
                     "precision_score": results['precision'],
-                    "recall_score": results['recall']  # Convert to list for logging
+                    "recall_score": results['recall'],  # Convert to list for logging
+                    "pr_auc": results['pr_auc'],
+                    "best_f1_score": results['best_f1'],
+                    "best_f1_threshold": results['best_threshold']
                 })
+                if results.get('parity'):
+                    tracker.log_metrics({"parity_pr_auc_lbfgs": results['parity']['pr_auc_lbfgs'],
+                                         "parity_pr_auc_difference": results['parity']['difference']})
 
-                mlflow.log_artifact("predictions/confusion_matrix.png", "predictions")
-                mlflow.log_artifact("predictions/predictions.csv", "predictions")
+                tracker.log_artifact("predictions/confusion_matrix.png", "predictions")
+                tracker.log_artifact("predictions/predictions.csv", "predictions")
 
-                mlflow.log_artifact("input data/dev.csv", "datasets")
-                mlflow.log_artifact("input data/oos.csv", "datasets")
-                mlflow.log_artifact("input data/oot.csv", "datasets")
+                tracker.log_dataset("input data/dev.csv", "datasets")
+                tracker.log_dataset("input data/oos.csv", "datasets")
+                tracker.log_dataset("input data/oot.csv", "datasets")
 
-                mlflow.log_artifact("encoded data/encoded_dev.csv", "encoded datasets")
-                mlflow.log_artifact("encoded data/encoded_oos.csv", "encoded datasets")
-                mlflow.log_artifact("encoded data/encoded_oot.csv", "encoded datasets")
+                if retrain_mode:
+                    tracker.log_dataset(default_hyperparameters['retrain']['new_data'], "datasets")
+                else:
+                    tracker.log_dataset("encoded data/encoded_dev.npz", "encoded datasets")
+                    tracker.log_dataset("encoded data/encoded_oos.npz", "encoded datasets")
+                    tracker.log_dataset("encoded data/encoded_oot.npz", "encoded datasets")
 
-                mlflow.log_artifact("saved best models/encoder_model.h5", "models")
-                mlflow.log_artifact("saved best models/autoencoder_model.h5", "models")
-                mlflow.log_artifact("saved best models/logistic_model.pkl", "models")
+                tracker.log_artifact("saved best models/encoder_model.h5", "models")
+                tracker.log_artifact("saved best models/autoencoder_model.h5", "models")
+                tracker.log_artifact("saved best models/logistic_model.pkl", "models")
+                tracker.log_artifact("saved best models/scaler.pkl", "models")
+                tracker.log_artifact("saved best models/features_dropped.json", "models")
+                tracker.log_artifact("saved best models/model_threshold.json", "models")
+                tracker.log_artifact("saved best models/fused_model.npz", "models")
                 
                 # Log success status
-                mlflow.log_param("status", "SUCCESS")
+                tracker.log_param("status", "SUCCESS")
                 
                 logging.info(f"Pipeline Run Successfully Completed")
                 logging.info(f"F1 Score: {results['f1']}")
@@ -76,8 +95,8 @@ def run_pipeline():
             except Exception as e:
                 logging.error(f"Error during run pipeline: {str(e)}")
                 logging.error(traceback.format_exc())
-                mlflow.log_param("status", "FAILED")
-                mlflow.log_param("error_message", str(e))
+                tracker.log_param("status", "FAILED")
+                tracker.log_param("error_message", str(e))
                 raise
                 
     except Exception as e:
@@ -2,11 +2,9 @@ import json
 import logging
 import mlflow
 import traceback
-from pipeline import *
-from feature_selection import *
-from prepare_data import *
-from autoencoder import *
-from mlflow_utils import *
+from pipeline import fs
+from instrumentation import stage_records
+from mlflow_utils import init_mlflow, AsyncLogger
 
 # Configure logging
 logging.basicConfig(
@@ -27,12 +25,12 @@ def run_feature_selection():
         # Initialize MLflow
         init_mlflow()
         
-        with mlflow.start_run() as run:
+        with mlflow.start_run() as run, AsyncLogger(run.info.run_id) as tracker:
             try:
                 logging.info("Running initial feature selection using default parameters")
                 
                 # Log parameters
-                mlflow.log_params({
+                tracker.log_params({
                     "feature_selection_method": default_hyperparameters['feature_selection'],
                     "feature_threshold": default_hyperparameters['feature_threshold'],
                     "autoencoder_params": default_hyperparameters['autoencoder']
@@ -40,28 +38,29 @@ def run_feature_selection():
                 
                 # Run feature selection
                 results = fs(default_hyperparameters)
+                tracker.log_stage_records(stage_records())
 
                 method = default_hyperparameters['feature_selection']
                 
                 # Log all metrics and artifacts
-                mlflow.keras.log_model(results["autoencoder_F"], "fraud_autoencoder")
-                mlflow.keras.log_model(results["autoencoder_NF"], "nonfraud_autoencoder")
+                tracker.log_model(mlflow.keras.save_model, results["autoencoder_F"], "fraud_autoencoder")
+                tracker.log_model(mlflow.keras.save_model, results["autoencoder_NF"], "nonfraud_autoencoder")
                 
                 # Log datasets
-                mlflow.log_artifact("input data/dev.csv", "datasets")
-                mlflow.log_artifact("input data/oos.csv", "datasets")
-                mlflow.log_artifact("input data/oot.csv", "datasets")
+                tracker.log_dataset("input data/dev.csv", "datasets")
+                tracker.log_dataset("input data/oos.csv", "datasets")
+                tracker.log_dataset("input data/oot.csv", "datasets")
 
-                mlflow.log_artifact('feature selection/abnormal_'+method+'_importance.csv', "feature_importance")
-                mlflow.log_artifact('feature selection/normal_'+method+'_importance.csv', "feature_importance")
+                tracker.log_artifact('feature selection/abnormal_'+method+'_importance.csv', "feature_importance")
+                tracker.log_artifact('feature selection/normal_'+method+'_importance.csv', "feature_importance")
             
                 # Log fraud autoencoder training metrics
-                mlflow.log_metric("fraud_autoencoder_final_loss", results["history_F"].history['loss'][-1])
-                mlflow.log_metric("fraud_autoencoder_final_val_loss", results["history_F"].history['val_loss'][-1])
+                tracker.log_metric("fraud_autoencoder_final_loss", results["history_F"].history['loss'][-1])
+                tracker.log_metric("fraud_autoencoder_final_val_loss", results["history_F"].history['val_loss'][-1])
                 
                 # Log non-fraud autoencoder training metrics
-                mlflow.log_metric("nonfraud_autoencoder_final_loss", results["history_NF"].history['loss'][-1])
-                mlflow.log_metric("nonfraud_autoencoder_final_val_loss", results["history_NF"].history['val_loss'][-1])
+                tracker.log_metric("nonfraud_autoencoder_final_loss", results["history_NF"].history['loss'][-1])
+                tracker.log_metric("nonfraud_autoencoder_final_val_loss", results["history_NF"].history['val_loss'][-1])
                 
                 # Log training curves for both autoencoders
                 import matplotlib.pyplot as plt
@@ -88,8 +87,12 @@ def run_feature_selection():
                 plt.savefig('figures/nonfraud_autoencoder_loss.png')
                 plt.close()
                 
+                # Log per-model training and importance timings
+                tracker.log_metrics({f"{name}_seconds": seconds for name, seconds in results["timings"].items()})
+                logging.info(f"Feature selection timings: {results['timings']}")
+                
                 # Log number of features dropped
-                mlflow.log_metric("num_features_dropped", len(results["features_dropped"]))
+                tracker.log_metric("num_features_dropped", len(results["features_dropped"]))
                 
                 figure_paths = ['figures/normal_'+method+'_importance.png', 
                                 'figures/abnormal_'+method+'_importance.png',
@@ -97,15 +100,15 @@ def run_feature_selection():
                                 'figures/nonfraud_autoencoder_loss.png']
                 
                 for fig_path in figure_paths:
-                    mlflow.log_artifact(fig_path, "important figures")
+                    tracker.log_artifact(fig_path, "important figures")
                 
                 # Log feature selection results
                 with open("feature selection/features_dropped.txt", "r") as f:
-                    mlflow.log_text(f.read(), "features_dropped.txt")
+                    tracker.log_text(f.read(), "features_dropped.txt")
                 
                 # Log success status
-                mlflow.log_param("status", "SUCCESS")
-                mlflow.log_metric("num_features_dropped", len(results['features_dropped']))
+                tracker.log_param("status", "SUCCESS")
+                tracker.log_metric("num_features_dropped", len(results['features_dropped']))
                 
                 logging.info(f"Feature selection completed. Dropped features: {results['features_dropped']}")
                 
@@ -114,8 +117,8 @@ def run_feature_selection():
             except Exception as e:
                 logging.error(f"Error during feature selection: {str(e)}")
                 logging.error(traceback.format_exc())
-                mlflow.log_param("status", "FAILED")
-                mlflow.log_param("error_message", str(e))
+                tracker.log_param("status", "FAILED")
+                tracker.log_param("error_message", str(e))
                 raise
                 
     except Exception as e:
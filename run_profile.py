@@ -0,0 +1,35 @@
+import sys
+import json
+import logging
+import traceback
+from profiling import drift_report
+
+# Configure logging
+logging.basicConfig(
+    filename='fraud_pipeline.log',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+def run_profile():
+    """Profile dev/oos/oot and report PSI drift against dev, e.g. before every run_fp.py"""
+    with open('default_hyperparameters.json', 'r') as f:
+        default_hyperparameters = json.load(f)
+
+    profiles, drift = drift_report(default_hyperparameters)
+    drifted = drift.index[drift['drifted']].tolist()
+    logging.info(f"PSI against dev: {drift.drop(columns='drifted').max().to_dict()}")
+    if drifted:
+        logging.warning(f"Features drifted beyond PSI {default_hyperparameters['profile']['psi_threshold']}: {drifted}")
+    print(drift.sort_values('psi_oot', ascending=False).head(10))
+    print(f"Drifted features: {drifted}")
+    return drift
+
+if __name__ == "__main__":
+    try:
+        run_profile()
+    except Exception as e:
+        logging.error(f"Error during profiling: {str(e)}")
+        logging.error(traceback.format_exc())
+        sys.exit(1)
@@ -0,0 +1,24 @@
+import argparse
+from scoring import ScoringService, serve
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the saved fraud models for online scoring")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--models-dir", default="saved best models")
+    parser.add_argument("--max-batch-rows", type=int, default=1024, help="largest merged batch")
+    parser.add_argument("--max-wait-ms", type=float, default=2.0, help="longest wait for more requests")
+    parser.add_argument("--backend", choices=["keras", "fused"], default="keras",
+                        help="'fused' scores with the NumPy export and never imports TensorFlow")
+    args = parser.parse_args(argv)
+
+    service = ScoringService(args.models_dir, args.max_batch_rows, args.max_wait_ms, backend=args.backend)
+    try:
+        serve(service, args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import os
+import json
+import logging
+import mlflow
+import traceback
+from search import hyperparameter_search
+from mlflow_utils import init_mlflow, AsyncLogger
+
+# Configure logging
+logging.basicConfig(
+    filename='hyperparameter_search.log',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+def log_trial(tracker, result):
+    """Log one search trial as nested MLflow runs, one per logistic setting"""
+    for model_trial in result.get('model_trials') or [{'model_params': {}, 'cv_pr_auc': None}]:
+        params = {f"autoencoder_{k}": v for k, v in result['autoencoder'].items()}
+        params.update({f"model_{k}": v for k, v in model_trial['model_params'].items()})
+        params['status'] = result['status']
+        metrics = {"val_loss": result['val_loss'], "epochs": result['epochs']}
+        if model_trial['cv_pr_auc'] is not None:
+            metrics["cv_pr_auc"] = model_trial['cv_pr_auc']
+        tracker.log_child_run(f"trial_{result['trial']}", params, metrics)
+    logging.info(f"Trial finished: {result}")
+
+def run_search():
+    try:
+        # Load hyperparameters
+        with open('default_hyperparameters.json', 'r') as f:
+            default_hyperparameters = json.load(f)
+
+        logging.info(f"Search space: {default_hyperparameters['search']}")
+
+        # Initialize MLflow
+        init_mlflow("Hyperparameter_Search")
+
+        with mlflow.start_run(run_name="search") as run, AsyncLogger(run.info.run_id) as tracker:
+            tracker.log_params({
+                "search_autoencoder": default_hyperparameters['search']['autoencoder'],
+                "search_model_params": default_hyperparameters['search']['model_params'],
+                "cross_validation": default_hyperparameters['cross_validation']
+            })
+            results, best = hyperparameter_search(default_hyperparameters, lambda result: log_trial(tracker, result))
+
+            os.makedirs('search results', exist_ok=True)
+            with open('search results/search_results.json', 'w') as f:
+                json.dump({'best': best, 'trials': results}, f, indent=4)
+            tracker.log_artifact('search results/search_results.json', "search")
+
+            if best is not None:
+                tracker.log_params({"best_autoencoder": best['autoencoder'],
+                                   "best_model_params": best['best_model_params']})
+                tracker.log_metric("best_cv_pr_auc", best['best_cv_pr_auc'])
+            tracker.log_metric("num_pruned", sum(r['status'] == 'pruned' for r in results))
+            logging.info(f"Best trial: {best}")
+            print(f"Best trial: {best}")
+            return best
+
+    except Exception as e:
+        logging.error(f"Error during hyperparameter search: {str(e)}")
+        logging.error(traceback.format_exc())
+        raise
+
+if __name__ == "__main__":
+    try:
+        run_search()
+    except Exception:
+        exit(1)
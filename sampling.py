@@ -0,0 +1,104 @@
+import numpy as np
+
+def reservoir_sample(chunks, k, seed=42):
+    """
+    Uniform sample of k rows from a stream of array chunks in one pass (algorithm R)
+
+    Only the k-row reservoir is held in memory, so chunks can come from a
+    memory-mapped array or a chunked file reader. Each chunk is handled with
+    vectorized draws: row t (0-based over the stream) replaces a random slot with
+    probability k / (t + 1), and when several rows of a chunk hit the same slot the
+    last one wins, as in the sequential algorithm.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir, seen = None, 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        if reservoir is None:
+            reservoir = np.empty((k,) + chunk.shape[1:], dtype=chunk.dtype)
+        fill = min(len(chunk), max(0, k - seen))
+        reservoir[seen:seen + fill] = chunk[:fill]
+        rest = chunk[fill:]
+        if len(rest):
+            t = seen + fill + np.arange(len(rest))
+            slots = (rng.random(len(rest)) * (t + 1)).astype(np.int64)
+            hits = np.nonzero(slots < k)[0]
+            # Keep the last hit of every slot
+            last = len(hits) - 1 - np.unique(slots[hits][::-1], return_index=True)[1]
+            reservoir[slots[hits[last]]] = rest[hits[last]]
+        seen += len(chunk)
+    if reservoir is None:
+        return np.empty(0)
+    return reservoir[:min(k, seen)]
+
+def stratified_sample(strata_values, k, bins=10, seed=42):
+    """
+    Positions of k rows sampled proportionally from quantile bins of strata_values
+
+    Every non-empty bin keeps at least one row, so the tails of the stratifying
+    column (e.g. very large amounts) are always represented. Returns sorted positions.
+    """
+    rng = np.random.default_rng(seed)
+    strata_values = np.asarray(strata_values)
+    edges = np.unique(np.quantile(strata_values, np.linspace(0, 1, bins + 1)[1:-1]))
+    strata = np.searchsorted(edges, strata_values, side='right')
+    counts = np.bincount(strata, minlength=len(edges) + 1)
+    quota = np.maximum(np.floor(counts * k / len(strata_values)).astype(np.int64), counts > 0)
+    # Hand out the rows lost to rounding to the largest strata
+    for stratum in np.argsort(-counts)[:max(0, k - quota.sum())]:
+        quota[stratum] = min(counts[stratum], quota[stratum] + 1)
+    positions = [rng.choice(np.nonzero(strata == stratum)[0], quota[stratum], replace=False)
+                 for stratum in range(len(counts)) if quota[stratum]]
+    return np.sort(np.concatenate(positions))
+
+def sample_indices(data, indices, k, sampling, feature_names, seed=None):
+    """
+    Sorted subset of k of the row indices of data, following the fs_sampling settings
+
+    sampling['method']: 'none' keeps every row, 'reservoir' draws a uniform sample
+    in one streaming pass over the indices, 'stratified' samples within quantile
+    bins of the sampling['stratify_on'] column. Only the selected rows are ever
+    gathered from data, so the cost downstream follows k rather than len(indices).
+    """
+    indices = np.asarray(indices)
+    method = sampling.get('method', 'none')
+    seed = sampling.get('seed', 42) if seed is None else seed
+    if method == 'none' or not k or k >= len(indices):
+        return indices
+    if method == 'reservoir':
+        chunks = (indices[start:start + 65536] for start in range(0, len(indices), 65536))
+        return np.sort(reservoir_sample(chunks, k, seed))
+    if method == 'stratified':
+        column = feature_names.index(sampling.get('stratify_on', 'Amount'))
+        return indices[stratified_sample(np.asarray(data[indices, column]), k, sampling.get('strata', 10), seed)]
+    raise ValueError("Unsupported sampling method. Use 'none', 'reservoir' or 'stratified'.")
+
+def rank_correlation(a, b):
+    """Spearman correlation of two importance vectors (ties broken by position)"""
+    ranks_a, ranks_b = np.argsort(np.argsort(a)), np.argsort(np.argsort(b))
+    return float(np.corrcoef(ranks_a, ranks_b)[0, 1])
+
+def top_k_overlap(a, b, k):
+    """Share of the k most important features of a that are also among the k most important of b"""
+    return len(np.intersect1d(np.argsort(a)[-k:], np.argsort(b)[-k:])) / k
+
+def ranking_convergence(importance, n_rows, full, fractions=(0.25, 0.5), top_k=5, seed=42):
+    """
+    How stable an importance ranking is as rows are added
+
+    importance(positions) computes the importance vector on the given rows of the
+    sample; nested random prefixes of fractions of the n_rows rows are compared with
+    full, the importance on all of them. Returns an array of (rows, spearman, top_k
+    overlap) rows, the last one being the full sample itself.
+    """
+    order = np.random.default_rng(seed).permutation(n_rows)
+    top_k = min(top_k, len(full))
+    results = []
+    for fraction in fractions:
+        rows = max(2, int(round(n_rows * fraction)))
+        if rows >= n_rows:
+            continue
+        prefix = importance(np.sort(order[:rows]))
+        results.append((rows, rank_correlation(prefix, full), top_k_overlap(prefix, full, top_k)))
+    results.append((n_rows, 1.0, 1.0))
+    return np.array(results)
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from fused_model import FusedModel
+
+def load_scoring_artifacts(models_dir='saved best models'):
+    """
+    Load the scaler, dropped-feature list, logistic model and decision threshold saved by pipeline()
+    """
+    import joblib
+
+    scaler = joblib.load(os.path.join(models_dir, 'scaler.pkl'))
+    model = joblib.load(os.path.join(models_dir, 'logistic_model.pkl'))
+    features_to_drop = []
+    if os.path.exists(os.path.join(models_dir, 'features_dropped.json')):
+        with open(os.path.join(models_dir, 'features_dropped.json'), 'r') as f:
+            features_to_drop = json.load(f)
+    threshold = 0.5
+    if os.path.exists(os.path.join(models_dir, 'model_threshold.json')):
+        with open(os.path.join(models_dir, 'model_threshold.json'), 'r') as f:
+            threshold = json.load(f)['threshold']
+    return scaler, features_to_drop, model, threshold
+
+def load_keras_encoder(models_dir, keep):
+    """
+    The saved Keras model from scaled features to the logistic model inputs, and the columns it takes
+
+    feature_model.keras (encoding plus reconstruction errors, saved when
+    reconstruction_features is on) takes every column; otherwise encoder_model.h5
+    takes the kept ones.
+    """
+    from keras.models import load_model
+
+    feature_model_path = os.path.join(models_dir, 'feature_model.keras')
+    if os.path.exists(feature_model_path):
+        model = load_model(feature_model_path, compile=False)
+        return model, np.arange(model.input_shape[1], dtype=np.intp)
+    return load_model(os.path.join(models_dir, 'encoder_model.h5'), compile=False), keep
+
+class ScoringService:
+    """
+    In-process scorer for single transactions and micro-batches
+
+    The saved artifacts are loaded once and the encoder is traced into a single
+    tf.function at start-up, so requests never pay for Keras graph construction.
+    With backend='fused' the pure-NumPy fused_model.npz is used instead and
+    TensorFlow is never imported.
+
+    Concurrent score() calls are queued and a worker thread merges them into
+    adaptive batches: everything already waiting is taken at once and, while the
+    traffic is concurrent, the worker waits at most max_wait_ms for more rows as
+    long as the batch is below max_batch_rows.
+    """
+
+    def __init__(self, models_dir='saved best models', max_batch_rows=1024, max_wait_ms=2.0,
+                 threshold=None, latency_window=100000, backend='keras'):
+        if backend == 'fused':
+            self.fused = FusedModel(os.path.join(models_dir, 'fused_model.npz'))
+            self.feature_names = self.fused.feature_names
+            self.threshold = self.fused.threshold if threshold is None else threshold
+        elif backend == 'keras':
+            self.fused = None
+            self._load_keras(models_dir, threshold)
+        else:
+            raise ValueError("Unsupported backend. Use 'keras' or 'fused'.")
+
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=latency_window)
+        self._batch_sizes = deque(maxlen=latency_window)
+        self._closed = False
+        # Guards _closed together with the enqueue, so no request can land behind the sentinel
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _load_keras(self, models_dir, threshold):
+        import tensorflow as tf
+
+        self.scaler, features_to_drop, self.model, saved_threshold = load_scoring_artifacts(models_dir)
+        self.threshold = saved_threshold if threshold is None else threshold
+        self.feature_names = list(self.scaler.feature_names_in_)
+        dropped = set(features_to_drop)
+        self.keep = np.array([i for i, name in enumerate(self.feature_names) if name not in dropped], dtype=np.intp)
+        self.mean = np.zeros(len(self.feature_names)) if self.scaler.mean_ is None else self.scaler.mean_
+        self.scale = np.ones(len(self.feature_names)) if self.scaler.scale_ is None else self.scaler.scale_
+        self.coef = self.model.coef_.ravel()
+        self.intercept = self.model.intercept_[0]
+
+        encoder, self.keep = load_keras_encoder(models_dir, self.keep)
+        self._encode = tf.function(lambda x: encoder(x, training=False),
+                                   input_signature=[tf.TensorSpec([None, len(self.keep)], tf.float32)])
+        self._encode(np.zeros((1, len(self.keep)), dtype=np.float32))
+
+    def to_matrix(self, rows):
+        """Turn a dict, list of dicts, list of lists, array or DataFrame into a float32 feature matrix"""
+        if isinstance(rows, dict):
+            rows = [rows]
+        # pandas is not imported by this module; a DataFrame can only arrive if the caller imported it
+        pd = sys.modules.get('pandas')
+        if pd is not None and isinstance(rows, pd.DataFrame):
+            rows = rows[self.feature_names].to_numpy()
+        elif isinstance(rows, list) and rows and isinstance(rows[0], dict):
+            rows = [[row[name] for name in self.feature_names] for row in rows]
+        matrix = np.asarray(rows, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix[None, :]
+        if matrix.shape[1] != len(self.feature_names):
+            raise ValueError(f"Expected {len(self.feature_names)} features, got {matrix.shape[1]}.")
+        return matrix
+
+    def score_batch(self, matrix):
+        """Fraud probabilities for a feature matrix, scored synchronously on the calling thread"""
+        if self.fused is not None:
+            return self.fused.predict_proba(matrix)
+        scaled = ((matrix - self.mean) / self.scale).astype(np.float32)[:, self.keep]
+        encoded = self._encode(scaled).numpy()
+        # Same as model.predict_proba(encoded)[:, 1] without sklearn's per-call validation
+        return 1 / (1 + np.exp(-(encoded @ self.coef + self.intercept)))
+
+    def score(self, rows):
+        """Fraud probabilities for one row or a micro-batch, batched with other concurrent requests"""
+        matrix = self.to_matrix(rows)
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Scoring service is closed.")
+            self._queue.put((matrix, future, time.perf_counter()))
+        return future.result()
+
+    def predict(self, rows):
+        """Fraud labels (score above the saved decision threshold)"""
+        return (self.score(rows) > self.threshold).astype(int)
+
+    def _run(self):
+        last_batch_requests = 1
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # Fail anything still queued behind the sentinel instead of leaving its caller waiting
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        return
+                    if item is not None:
+                        item[1].set_exception(RuntimeError("Scoring service is closed."))
+            batch = [item]
+            n_rows = len(item[0])
+            # Only hold a batch open when the previous one merged several requests,
+            # so a lone request under light load is scored immediately
+            deadline = time.perf_counter() + (self.max_wait if last_batch_requests > 1 else 0)
+            while n_rows < self.max_batch_rows:
+                try:
+                    timeout = deadline - time.perf_counter()
+                    item = self._queue.get_nowait() if timeout <= 0 else self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                n_rows += len(item[0])
+            last_batch_requests = len(batch)
+
+            try:
+                scores = self.score_batch(np.concatenate([matrix for matrix, _, _ in batch]))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            start = 0
+            for matrix, future, received in batch:
+                future.set_result(scores[start:start + len(matrix)])
+                start += len(matrix)
+                self._latencies.append(done - received)
+            self._batch_sizes.append(n_rows)
+
+    def latency_stats(self):
+        """p50/p99/mean request latency in milliseconds and the mean batch size"""
+        if not self._latencies:
+            return {'requests': 0}
+        latencies = np.array(self._latencies) * 1000
+        return {
+            'requests': len(latencies),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'mean_ms': float(latencies.mean()),
+            'mean_batch_rows': float(np.mean(self._batch_sizes))
+        }
+
+    def close(self):
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        self._worker.join()
+
+def serve(service, host='127.0.0.1', port=8080):
+    """
+    Serve a ScoringService over HTTP
+
+    POST /score with {"rows": ...} (a feature dict, a list of dicts or a list of lists)
+    returns {"scores": [...], "labels": [...]}; GET /stats returns latency_stats().
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, service.latency_stats())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                return self._reply(404, {'error': 'not found'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                scores = service.score(request['rows'])
+            except (ValueError, KeyError) as e:
+                return self._reply(400, {'error': str(e)})
+            self._reply(200, {'scores': scores.tolist(),
+                              'labels': (scores > service.threshold).astype(int).tolist()})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Scoring service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        print(f"Latency: {service.latency_stats()}")
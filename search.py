@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from keras.callbacks import Callback
+from keras.models import Sequential
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from prepare_data import preprocess_data, encode_data, file_md5
+from feature_selection import load_features_to_drop, feature_indices, select_columns, pin_threads, thread_env
+from autoencoder import build_autoencoder_from_config, fit_autoencoder
+
+def expand_grid(grid):
+    """All combinations of a {name: [values]} grid as a list of {name: value} dicts"""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+class PruningCallback(Callback):
+    """
+    Stop an autoencoder trial whose val_loss is worse than the median of the other trials
+
+    Every trial reports its val_loss per epoch into a dict shared between the worker
+    processes. From prune_after_epochs on, once at least min_trials other trials have
+    reached the same epoch, a trial above their median val_loss is stopped.
+    """
+
+    def __init__(self, shared_losses, lock, prune_after_epochs=2, min_trials=2):
+        super().__init__()
+        self.shared_losses = shared_losses
+        self.lock = lock
+        self.prune_after_epochs = prune_after_epochs
+        self.min_trials = min_trials
+        self.pruned = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        val_loss = logs['val_loss']
+        with self.lock:
+            others = list(self.shared_losses.get(epoch, []))
+            self.shared_losses[epoch] = others + [val_loss]
+        if epoch + 1 >= self.prune_after_epochs and len(others) >= self.min_trials \
+                and val_loss > np.median(others):
+            self.pruned = True
+            self.model.stop_training = True
+
+def encoded_cache_path(hyperparameters, ae_params, features_to_drop):
+    """Where the encoded dev/oos features of one autoencoder configuration are cached"""
+    cache_dir = hyperparameters['data_cache'] or 'cached data'
+    key = hashlib.md5(json.dumps({
+        'inputs': [file_md5(path, cache_dir) for path in (hyperparameters['train_file'], hyperparameters['validation_file'])],
+        'train_on': hyperparameters['train_on'],
+        'autoencoder': dict(hyperparameters['autoencoder'], **ae_params),
+        'features_to_drop': sorted(features_to_drop)
+    }, sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_dir, 'search', f'{key}.npz')
+
+def run_trial(trial_id, ae_params, model_grid, hyperparameters, shared_losses, lock):
+    """
+    Train one autoencoder configuration and cross-validate every logistic setting on its encoding
+
+    Encoded features are cached per autoencoder configuration, so trials that only change
+    logistic parameters (within this grid or in a later search) skip autoencoder training.
+    """
+    search = hyperparameters['search']
+    data = preprocess_data(hyperparameters['train_file'], hyperparameters['validation_file'],
+                           hyperparameters['test_file'], hyperparameters['target_column'],
+                           hyperparameters['data_cache'])
+    features_to_drop = load_features_to_drop() or []
+    keep = feature_indices(features_to_drop, data['feature_names'])
+    result = {'trial': trial_id, 'autoencoder': ae_params, 'status': 'complete', 'val_loss': None, 'epochs': 0}
+
+    cache_path = encoded_cache_path(hyperparameters, ae_params, features_to_drop)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            X, result['val_loss'] = cached['X'], float(cached['val_loss'])
+        result['status'] = 'cached'
+    else:
+        rows = ('dev_NF_idx', 'oos_NF_idx') if hyperparameters['train_on'] == 'normal' else ('dev_F_idx', 'oos_F_idx')
+        train_on = select_columns(data['dev_scaled'], keep, data[rows[0]])
+        val_on = select_columns(data['oos_scaled'], keep, data[rows[1]])
+        autoencoder = build_autoencoder_from_config(train_on.shape[1], hyperparameters['autoencoder'], **ae_params)
+        pruning = PruningCallback(shared_losses, lock, search['prune_after_epochs'], search['prune_min_trials'])
+        history = fit_autoencoder(autoencoder, train_on, val_on, hyperparameters['autoencoder']['epochs'],
+                                  ae_params['batch_size'], callbacks=[pruning], verbose=0)
+        result['val_loss'] = float(min(history.history['val_loss']))
+        result['epochs'] = len(history.history['val_loss'])
+        if pruning.pruned:
+            result['status'] = 'pruned'
+            return result
+        encoder = Sequential(autoencoder.layers[:4])
+        chunk_size = hyperparameters['encode_chunk_size']
+        X = np.concatenate([encode_data(encoder, data['dev_scaled'], chunk_size, keep),
+                            encode_data(encoder, data['oos_scaled'], chunk_size, keep)])
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.savez(cache_path, X=X, val_loss=result['val_loss'])
+
+    y = np.concatenate([data['y_dev'], data['y_oos']])
+    base_params = {k: v for k, v in hyperparameters['model_params'].items() if k not in model_grid}
+    grid = GridSearchCV(LogisticRegression(**base_params), model_grid, scoring='average_precision',
+                        cv=StratifiedKFold(hyperparameters['cross_validation'], shuffle=True, random_state=42))
+    grid.fit(X, y)
+    result['model_trials'] = [{'model_params': params, 'cv_pr_auc': float(score)}
+                              for params, score in zip(grid.cv_results_['params'], grid.cv_results_['mean_test_score'])]
+    result['best_model_params'] = grid.best_params_
+    result['best_cv_pr_auc'] = float(grid.best_score_)
+    return result
+
+def hyperparameter_search(hyperparameters, on_result=None):
+    """
+    Parallel grid search over the 'search' section of the hyperparameters
+
+    Autoencoder configurations run as trials in a process pool (threads split evenly
+    between the workers) and weak ones are pruned early on val_loss. on_result is
+    called in the parent process with each finished trial, e.g. to log it to MLflow.
+    Returns all trial results and the best one by cross-validated PR-AUC.
+    """
+    search = hyperparameters['search']
+    ae_grid = expand_grid(search['autoencoder'])
+    model_grid = search['model_params']
+    workers = min(search['workers'], len(ae_grid))
+
+    # Build the shared preprocessing artifact once before the workers memory-map it
+    preprocess_data(hyperparameters['train_file'], hyperparameters['validation_file'],
+                    hyperparameters['test_file'], hyperparameters['target_column'],
+                    hyperparameters['data_cache'])
+
+    context = multiprocessing.get_context('spawn')
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    results = []
+    with context.Manager() as manager:
+        shared_losses, lock = manager.dict(), manager.Lock()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=pin_threads,
+                                 initargs=(threads,)) as executor:
+            # Workers are spawned on submit, with the pinned environment
+            with thread_env(threads):
+                futures = [executor.submit(run_trial, i, ae_params, model_grid, hyperparameters, shared_losses, lock)
+                           for i, ae_params in enumerate(ae_grid)]
+            for future in as_completed(futures):
+                result = future.result()
+                print(f"Trial {result['trial']} {result['status']}: val_loss={result['val_loss']}, "
+                      f"cv_pr_auc={result.get('best_cv_pr_auc')}")
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+
+    results.sort(key=lambda r: r['trial'])
+    finished = [r for r in results if r['status'] != 'pruned']
+    best = max(finished, key=lambda r: r['best_cv_pr_auc']) if finished else None
+    return results, best
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import joblib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Stage:
+    """
+    One step of the pipeline DAG
+
+    func(inputs) gets the outputs of deps as {dep name: outputs dict} and returns a
+    dict of outputs. config is only hashed: together with version and the fingerprints
+    of the deps it forms the stage key, so it must hold everything that changes the
+    outputs. With cache=False the outputs are never stored and the stage always runs
+    (for steps that are cheap or keep their own cache, like preprocess_data).
+    fingerprint(outputs) returns the JSON-serializable part of the outputs that the
+    stages depending on this one consume (e.g. the dropped features); those stages are
+    then keyed on its hash, so a rerun that produces the same content reuses them.
+    Without it the fingerprint is the stage key itself.
+    """
+
+    def __init__(self, name, func, deps=(), config=None, version=1, cache=True, fingerprint=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.config = config
+        self.version = version
+        self.cache = cache
+        self.fingerprint = fingerprint
+
+class ArtifactStore:
+    """
+    Typed local store of stage outputs under root/<stage>/<key>
+
+    NumPy arrays are saved as .npy and memory-mapped on load, Keras models as .keras,
+    JSON-serializable values as .json and anything else (scalers, sklearn models,
+    DataFrames) with joblib. The stage's content fingerprint, if it has one, goes to
+    fingerprint.json. manifest.json is written last and marks a complete entry.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def contains(self, stage, key):
+        return os.path.exists(os.path.join(self.path(stage, key), 'manifest.json'))
+
+    def fingerprint(self, stage, key):
+        """The content fingerprint saved with an entry, None if it has none"""
+        path = os.path.join(self.path(stage, key), 'fingerprint.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def save(self, stage, key, outputs, fingerprint=None):
+        import keras
+
+        artifact_dir = self.path(stage, key)
+        tmp_dir = artifact_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        manifest = {}
+        for name, value in outputs.items():
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(tmp_dir, f'{name}.npy'), value)
+                manifest[name] = 'npy'
+            elif isinstance(value, keras.Model):
+                value.save(os.path.join(tmp_dir, f'{name}.keras'))
+                manifest[name] = 'keras'
+            elif value is None or isinstance(value, (dict, list, str, int, float, bool, np.number)):
+                with open(os.path.join(tmp_dir, f'{name}.json'), 'w') as f:
+                    json.dump(value, f, default=float)
+                manifest[name] = 'json'
+            else:
+                joblib.dump(value, os.path.join(tmp_dir, f'{name}.pkl'))
+                manifest[name] = 'pkl'
+        if fingerprint is not None:
+            with open(os.path.join(tmp_dir, 'fingerprint.json'), 'w') as f:
+                json.dump(fingerprint, f)
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=4)
+        shutil.rmtree(artifact_dir, ignore_errors=True)
+        os.replace(tmp_dir, artifact_dir)
+
+    def load(self, stage, key):
+        artifact_dir = self.path(stage, key)
+        with open(os.path.join(artifact_dir, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        outputs = {}
+        for name, kind in manifest.items():
+            path = os.path.join(artifact_dir, f'{name}.{kind}')
+            if kind == 'npy':
+                outputs[name] = np.load(path, mmap_mode='r')
+            elif kind == 'keras':
+                from keras.models import load_model
+                outputs[name] = load_model(path)
+            elif kind == 'json':
+                with open(path, 'r') as f:
+                    outputs[name] = json.load(f)
+            else:
+                outputs[name] = joblib.load(path)
+        return outputs
+
+def _digest(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+def stage_key(stage, dep_fingerprints):
+    """Hash of the stage's name, version, config and the fingerprints of its deps"""
+    return _digest({
+        'stage': stage.name,
+        'version': stage.version,
+        'config': stage.config,
+        'deps': {dep: dep_fingerprints[dep] for dep in stage.deps}
+    })
+
+def run_stages(stages, targets, store, max_workers=None):
+    """
+    Produce the outputs of the target stages, running only what is not stored yet
+
+    Stages must be listed after their deps. A stage whose key is known up front (its
+    deps' fingerprints are known without running them) and is stored is loaded, and
+    its dependencies are not visited at all. Every other needed stage waits for its
+    dependencies; its key is then computed from their actual fingerprints, so it is
+    still loaded when a dependency reran but produced the same content. Independent
+    stages run concurrently in a thread pool. Returns the outputs of every stage that
+    was loaded or run and a {stage: {'status', 'seconds', 'key'}} report.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    seen = set()
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in seen]
+        if missing:
+            raise ValueError(f"Stage {stage.name} is listed before its dependencies {missing}.")
+        seen.add(stage.name)
+
+    keys, fingerprints = {}, {}
+    def known_key(name):
+        """The stage key if every dep fingerprint is known without running anything, else None"""
+        if name not in keys:
+            dep_fingerprints = {dep: known_fingerprint(dep) for dep in by_name[name].deps}
+            if any(value is None for value in dep_fingerprints.values()):
+                return None
+            keys[name] = stage_key(by_name[name], dep_fingerprints)
+        return keys[name]
+    def known_fingerprint(name):
+        if name not in fingerprints:
+            stage, key = by_name[name], known_key(name)
+            if key is None:
+                return None
+            if stage.fingerprint is None:
+                fingerprints[name] = key
+            elif stage.cache and store.contains(name, key) and store.fingerprint(name, key) is not None:
+                fingerprints[name] = store.fingerprint(name, key)
+            else:
+                return None
+        return fingerprints[name]
+
+    # Stored stages with a known key are loaded without their deps; the rest run after theirs
+    loaded = {}
+    def visit(name):
+        if name in loaded:
+            return
+        stage = by_name[name]
+        key = known_key(name)
+        loaded[name] = key is not None and stage.cache and store.contains(name, key)
+        if not loaded[name]:
+            for dep in stage.deps:
+                visit(dep)
+    for target in targets:
+        visit(target)
+
+    def execute(stage, key, inputs):
+        start = time.perf_counter()
+        cached = stage.cache and store.contains(stage.name, key)
+        if cached:
+            outputs = store.load(stage.name, key)
+            fingerprint = store.fingerprint(stage.name, key)
+        else:
+            outputs = stage.func(inputs)
+            fingerprint = None
+        if stage.fingerprint is not None and fingerprint is None:
+            fingerprint = _digest(stage.fingerprint(outputs))
+        if stage.cache and not cached:
+            store.save(stage.name, key, outputs, fingerprint)
+        return outputs, fingerprint or key, cached, time.perf_counter() - start
+
+    results, report, running = {}, {}, {}
+    pending = [stage.name for stage in stages if stage.name in loaded]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name in list(pending):
+                stage = by_name[name]
+                if loaded[name] or all(dep in results for dep in stage.deps):
+                    key = keys[name] if loaded[name] else stage_key(stage, {dep: fingerprints[dep] for dep in stage.deps})
+                    keys[name] = key
+                    inputs = {} if loaded[name] else {dep: results[dep] for dep in stage.deps}
+                    running[executor.submit(execute, stage, key, inputs)] = name
+                    pending.remove(name)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], fingerprints[name], cached, seconds = future.result()
+                report[name] = {'status': 'cached' if cached else 'ran', 'seconds': seconds, 'key': keys[name]}
+                print(f"Stage {name} {report[name]['status']} in {seconds:.2f}s ({keys[name][:12]})")
+    return results, report